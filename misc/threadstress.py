@@ -0,0 +1,171 @@
+'''
+Threaded stress benchmark.
+
+A set of OpenFlow 1.3 messages (with Nicira extensions) is generated in a child process, so
+the types are not compiled in this process. Then several threads start at the same time and parse
+the messages in different orders: the first parses race on compiling the parsers on demand. At the
+same time, another thread keeps defining new sub-class types of the same base types. Every parse
+result is checked against the message type and the original bytes.
+
+The test is repeated with different thread counts (each in a new process, to start with
+uncompiled types), and the throughput is reported. On free-threaded CPython builds the threads
+really run in parallel.
+
+Usage::
+
+    python -m misc.threadstress
+    python -m misc.threadstress -t 1 -t 8 -n 2000
+
+The exit code is 1 if any error is found.
+
+Created on 2026/10/18
+
+:author: hubo
+'''
+from __future__ import print_function
+import sys
+import threading
+import binascii
+import random
+import subprocess
+from timeit import default_timer
+
+
+def generate():
+    '''
+    :returns: a list of (type name, packed bytes)
+    '''
+    from misc.openflow import openflow13 as ofp
+    from misc.openflow.common import ETHERTYPE_IP
+    messages = []
+    fm = ofp.ofp_flow_mod.new(priority = ofp.OFP_DEFAULT_PRIORITY, command = ofp.OFPFC_ADD, buffer_id = ofp.OFP_NO_BUFFER)
+    fm.match = ofp.ofp_match_oxm.new()
+    fm.match.oxm_fields.append(ofp.create_oxm(ofp.OXM_OF_ETH_TYPE, ETHERTYPE_IP))
+    fm.match.oxm_fields.append(ofp.create_oxm(ofp.OXM_OF_IPV4_SRC_W, [192, 168, 1, 0], [255, 255, 255, 0]))
+    apply = ofp.ofp_instruction_actions.new(type = ofp.OFPIT_APPLY_ACTIONS)
+    apply.actions.append(ofp.ofp_action_set_field.new(field = ofp.create_oxm(ofp.OXM_OF_IPV4_SRC, [10, 0, 0, 1])))
+    apply.actions.append(ofp.nx_action_resubmit.new(in_port = 1, table = 1))
+    fm.instructions.append(apply)
+    fm.instructions.append(ofp.ofp_instruction_goto_table.new(table_id = 2))
+    messages.append(fm)
+    po = ofp.ofp_packet_out.new(buffer_id = ofp.OFP_NO_BUFFER, in_port = ofp.OFPP_CONTROLLER, data = b'\x00' * 64)
+    po.actions.append(ofp.ofp_action_output.new(port = 3))
+    messages.append(po)
+    gm = ofp.ofp_group_mod.new(command = ofp.OFPGC_ADD, type = ofp.OFPGT_SELECT, group_id = 1)
+    for i in range(0, 4):
+        b = ofp.ofp_bucket.new(weight = 1)
+        b.actions.append(ofp.ofp_action_output.new(port = i + 1))
+        gm.buckets.append(b)
+    messages.append(gm)
+    pi = ofp.ofp_packet_in.new(buffer_id = ofp.OFP_NO_BUFFER, reason = ofp.OFPR_NO_MATCH, data = b'\x01' * 60)
+    pi.match = ofp.ofp_match_oxm.new()
+    pi.match.oxm_fields.append(ofp.create_oxm(ofp.OXM_OF_IN_PORT, 1))
+    messages.append(pi)
+    fs = ofp.ofp_flow_stats_request.new(table_id = ofp.OFPTT_ALL, out_port = ofp.OFPP_ANY, out_group = ofp.OFPG_ANY)
+    fs.match = ofp.ofp_match_oxm.new()
+    messages.append(fs)
+    return [(repr(m._gettype()), m._tobytes()) for m in messages]
+
+
+def _definer(stop, count, limit = 1000):
+    # Keep defining new sub-class types of the types being parsed, with classify values which are
+    # not used by the messages
+    from namedstruct import nstruct, uint8, packvalue
+    from misc.openflow import openflow13 as ofp
+    i = 0
+    while not stop.is_set() and i < limit:
+        nstruct((uint8, 'value'),
+                base = ofp.ofp_msg,
+                classifyby = (200 + i % 50,),
+                init = packvalue(200 + i % 50, 'header', 'type'),
+                name = 'threadstress_msg_%d' % (i,))
+        nstruct((uint8, 'value'),
+                base = ofp.ofp_action,
+                classifyby = (0x1000 + i % 50,),
+                init = packvalue(0x1000 + i % 50, 'type'),
+                name = 'threadstress_action_%d' % (i,))
+        i += 1
+    count.append(i)
+
+
+def run(messages, threadcount, number):
+    '''
+    Parse the messages from *threadcount* threads, *number* messages per thread.
+
+    :returns: (seconds, error list, defined types count)
+    '''
+    from misc.openflow import openflow13 as ofp
+    errors = []
+    start = threading.Event()
+    stop = threading.Event()
+    def worker(seed):
+        rnd = random.Random(seed)
+        order = [rnd.randrange(0, len(messages)) for _ in range(0, number)]
+        start.wait()
+        try:
+            for i in order:
+                name, data = messages[i]
+                r = ofp.ofp_msg.create(data)
+                if repr(r._gettype()) != name:
+                    errors.append('%s parsed as %r' % (name, r._gettype()))
+                elif r._tobytes() != data:
+                    errors.append('%s packed to different bytes' % (name,))
+        except Exception as exc:
+            errors.append('%s: %r' % (messages[i][0], exc))
+    threads = [threading.Thread(target = worker, args = (n,)) for n in range(0, threadcount)]
+    defined = []
+    definer = threading.Thread(target = _definer, args = (stop, defined))
+    for t in threads:
+        t.start()
+    definer.start()
+    begin = default_timer()
+    start.set()
+    for t in threads:
+        t.join()
+    elapsed = default_timer() - begin
+    stop.set()
+    definer.join()
+    return (elapsed, errors, defined[0])
+
+
+def main(args = None):
+    import argparse
+    argparser = argparse.ArgumentParser(description = 'Parse OpenFlow messages from many threads')
+    argparser.add_argument('-t', '--threads', type = int, action = 'append',
+                           help = 'thread count, may be specified more than once (default: 1, 2, 4, 8)')
+    argparser.add_argument('-n', '--number', type = int, default = 1000, help = 'messages parsed by each thread')
+    argparser.add_argument('--generate', action = 'store_true', help = argparse.SUPPRESS)
+    argparser.add_argument('--single', type = int, default = None, help = argparse.SUPPRESS)
+    options = argparser.parse_args(args)
+    if options.generate:
+        for name, data in generate():
+            print(name, binascii.hexlify(data).decode('ascii'))
+        return 0
+    if options.single is not None:
+        messages = []
+        for line in sys.stdin:
+            name, data = line.split()
+            messages.append((name, binascii.unhexlify(data)))
+        elapsed, errors, defined = run(messages, options.single, options.number)
+        total = options.single * options.number
+        print('%8d %12d %12.3f %14.0f %10d %8d' % (options.single, total, elapsed, total / elapsed, defined, len(errors)))
+        for e in errors[:10]:
+            print('    ' + e)
+        return 1 if errors else 0
+    generated = subprocess.check_output([sys.executable, '-m', 'misc.threadstress', '--generate'])
+    if getattr(sys, '_is_gil_enabled', None) is not None:
+        print('GIL enabled: %r' % (sys._is_gil_enabled(),))
+    print('%8s %12s %12s %14s %10s %8s' % ('threads', 'messages', 'seconds', 'messages/s', 'defined', 'errors'))
+    sys.stdout.flush()
+    result = 0
+    for n in (options.threads or [1, 2, 4, 8]):
+        p = subprocess.Popen([sys.executable, '-m', 'misc.threadstress', '--single', str(n), '-n', str(options.number)],
+                             stdin = subprocess.PIPE)
+        p.communicate(generated)
+        if p.returncode:
+            result = 1
+    return result
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+'''
+Worst-case input benchmark.
+
+Every case generates a pathological but valid input of a given size: very long raw data and
+C-style strings, huge variable length arrays of tiny elements, OpenFlow messages with a lot of
+nested instructions and actions, bitwise enumerate types with a lot of values. The input size
+is doubled on each step, and the time used by parse / create / dump is recorded. A log-log
+linear fit of time against input size gives the scaling exponent: about 1.0 means linear,
+2.0 means quadratic. Cases with an exponent larger than the threshold are flagged.
+
+Usage::
+
+    python -m misc.worstcase
+    python -m misc.worstcase -c cstr -c uint8_array --max-size 65536 --threshold 1.3
+
+The exit code is 1 if any case is flagged.
+
+Created on 2026/10/18
+
+:author: hubo
+'''
+from __future__ import print_function
+import math
+import sys
+from timeit import default_timer
+from namedstruct import *
+from misc.openflow import openflow13 as ofp
+
+
+raw_struct = nstruct((uint32, 'length'),
+                     (raw, 'data'),
+                     name = 'raw_struct',
+                     padding = 1,
+                     size = lambda x: x.length,
+                     prepack = packrealsize('length'))
+
+cstr_struct = nstruct((cstr, 'data'),
+                      (uint8, 'tail'),
+                      name = 'cstr_struct',
+                      padding = 1)
+
+tiny = nstruct((uint8, 'a'),
+               name = 'tiny',
+               padding = 1)
+
+tiny_array = nstruct((uint32, 'length'),
+                     (tiny[0], 'items'),
+                     name = 'tiny_array',
+                     padding = 1,
+                     size = lambda x: x.length,
+                     prepack = packrealsize('length'))
+
+tiny_darray = nstruct((uint32, 'count'),
+                      (darray(tiny, 'items', lambda x: x.count),),
+                      name = 'tiny_darray',
+                      padding = 1,
+                      prepack = packexpr(lambda x: len(x.items), 'count'))
+
+
+def _raw(n):
+    return (raw_struct, raw_struct(data = b'x' * n)._tobytes())
+
+def _cstr(n):
+    return (cstr_struct, cstr_struct(data = b'x' * n, tail = 1)._tobytes())
+
+def _uint8_array(n):
+    return (uint8[0], b'\x01' * n)
+
+def _tiny_array(n):
+    return (tiny_array, tiny_array(items = [tiny(a = 1) for _ in range(0, n)])._tobytes())
+
+def _tiny_darray(n):
+    return (tiny_darray, tiny_darray(items = [tiny(a = 1) for _ in range(0, n)])._tobytes())
+
+def _ofp_actions(n):
+    apply = ofp.ofp_instruction_actions.new(type = ofp.OFPIT_APPLY_ACTIONS)
+    for i in range(0, n):
+        apply.actions.append(ofp.ofp_action_set_field.new(field = ofp.create_oxm(ofp.OXM_OF_IPV4_SRC, [10, 0, 0, i & 0xff])))
+    fm = ofp.ofp_flow_mod.new(command = ofp.OFPFC_ADD, buffer_id = ofp.OFP_NO_BUFFER,
+                              match = ofp.ofp_match_oxm.new())
+    fm.instructions.append(apply)
+    return (ofp.ofp_msg, fm._tobytes())
+
+def _ofp_instructions(n):
+    fm = ofp.ofp_flow_mod.new(command = ofp.OFPFC_ADD, buffer_id = ofp.OFP_NO_BUFFER,
+                              match = ofp.ofp_match_oxm.new())
+    for i in range(0, n):
+        ins = ofp.ofp_instruction_actions.new(type = ofp.OFPIT_WRITE_ACTIONS)
+        ins.actions.append(ofp.ofp_action_output.new(port = i + 1))
+        fm.instructions.append(ins)
+    return (ofp.ofp_msg, fm._tobytes())
+
+def _bitwise_enum(n):
+    # n enumerate values, the dumped value matches all of them
+    e = enum('worstcase_enum', None, uint64, True,
+             **dict(('V%d' % (i,), 1 << (i % 64)) for i in range(0, n)))
+    s = nstruct((e, 'flags'),
+                name = 'worstcase_enum_struct',
+                padding = 1)
+    return (s, b'\xff' * 8)
+
+
+def _parse(t, data):
+    t.parse(data)
+
+def _create(t, data):
+    t.create(data)
+
+def _dump(t, data):
+    dump(t.create(data))
+
+
+# (name, generator, operation, smallest size, largest size)
+cases = [('raw', _raw, _create, 1024, 1 << 22),
+         ('cstr', _cstr, _parse, 256, 1 << 18),
+         ('cstr_create', _cstr, _create, 256, 1 << 18),
+         ('uint8_array', _uint8_array, _create, 256, 1 << 18),
+         ('tiny_array', _tiny_array, _create, 256, 1 << 16),
+         ('tiny_darray', _tiny_darray, _create, 256, 1 << 16),
+         ('ofp_actions', _ofp_actions, _create, 16, 2048),
+         ('ofp_instructions', _ofp_instructions, _create, 16, 2048),
+         ('ofp_actions_dump', _ofp_actions, _dump, 16, 2048),
+         ('bitwise_enum_dump', _bitwise_enum, _dump, 16, 4096)]
+
+
+def measure(func, t, data, mintime = 0.05, repeat = 3):
+    '''
+    :returns: seconds used by a single call, the best of *repeat* runs
+    '''
+    best = None
+    for _ in range(0, repeat):
+        number = 0
+        start = default_timer()
+        while True:
+            func(t, data)
+            number += 1
+            elapsed = default_timer() - start
+            if elapsed >= mintime:
+                break
+        if best is None or elapsed / number < best:
+            best = elapsed / number
+    return best
+
+
+def slope(points):
+    '''
+    Least squares fit of log(time) = k * log(size) + b
+
+    :returns: k
+    '''
+    xs = [math.log(s) for s, _ in points]
+    ys = [math.log(t) for _, t in points]
+    mx = sum(xs) / len(xs)
+    my = sum(ys) / len(ys)
+    sxx = sum((x - mx) ** 2 for x in xs)
+    if sxx == 0:
+        return 0.0
+    return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx
+
+
+def run(name, generator, func, minsize, maxsize, threshold, stream = sys.stdout):
+    '''
+    Run a case with doubling sizes.
+
+    :returns: (exponent, flagged)
+    '''
+    points = []
+    n = minsize
+    print('%s:' % (name,), file = stream)
+    print('  %10s %10s %14s %14s' % ('n', 'bytes', 'time(ms)', 'per n(us)'), file = stream)
+    while n <= maxsize:
+        t, data = generator(n)
+        elapsed = measure(func, t, data)
+        points.append((n, elapsed))
+        print('  %10d %10d %14.3f %14.4f' % (n, len(data), elapsed * 1000.0, elapsed * 1000000.0 / n), file = stream)
+        n *= 2
+    # Small inputs are dominated by constant overhead, and copying is cheap until the buffer is
+    # large, so fit the three largest sizes only
+    k = slope(points[-3:])
+    flagged = k > threshold
+    print('  exponent: %.2f%s' % (k, ' SUPER-LINEAR' if flagged else ''), file = stream)
+    return (k, flagged)
+
+
+def main(args = None):
+    import argparse
+    argparser = argparse.ArgumentParser(description = 'Worst-case input benchmark, flags super-linear parsing')
+    argparser.add_argument('-c', '--case', action = 'append', choices = [c[0] for c in cases],
+                           help = 'run only these cases (default: all)')
+    argparser.add_argument('--max-size', type = int, default = None,
+                           help = 'limit the largest input size of every case')
+    argparser.add_argument('--threshold', type = float, default = 1.3,
+                           help = 'flag cases with a scaling exponent larger than this value')
+    options = argparser.parse_args(args)
+    flagged = []
+    for name, generator, func, minsize, maxsize in cases:
+        if options.case and name not in options.case:
+            continue
+        if options.max_size is not None:
+            maxsize = max(min(maxsize, options.max_size), minsize)
+        k, f = run(name, generator, func, minsize, maxsize, options.threshold)
+        if f:
+            flagged.append((name, k))
+    print()
+    if flagged:
+        print('Super-linear cases:')
+        for name, k in flagged:
+            print('  %-30s %.2f' % (name, k))
+        return 1
+    else:
+        print('No super-linear case found.')
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,9 @@
 from __future__ import absolute_import
-from namedstruct.namedstruct import dump, DUMPTYPE_FLAT, DUMPTYPE_KEY, DUMPTYPE_NONE, packexpr, packsize, packrealsize,\
+from namedstruct.namedstruct import dump, DUMPTYPE_FLAT, DUMPTYPE_KEY, DUMPTYPE_NONE, COMPARE_BYTES, COMPARE_FIELDS, packexpr, packsize, packrealsize,\
     packvalue, sizefromlen, nstruct, prim, raw, char, enum, varchr, cstr, optional, bitfield, darray, typedef,\
-    NamedStruct, nvariant
+    NamedStruct, nvariant, tlvlist, TLVList, lazyarray, LazyList, zerocopy, materialize
 from namedstruct.stdprim import *
+from namedstruct.counters import enable_stats, disable_stats, stats, reset_stats
+from namedstruct.parsecache import enable_cache, disable_cache, cache_stats
+from namedstruct.recordbatch import RecordBatch
+from namedstruct.expr import F, Expr, not_, and_, or_
@@ -0,0 +1,266 @@
+'''
+Declarative expressions for struct options.
+
+Options like *size*, *criteria*, *classifier* and *prepack* are usually lambda expressions, which
+cannot be analyzed by the library. Expressions built from F can be used instead::
+
+    from namedstruct import F
+    ofp_msg = nstruct((ofp_header,), name = 'ofp_msg', padding = 1,
+                      size = F.header.length, classifier = F.header.type, ...)
+    ofp_match_oxm = nstruct(..., base = ofp_match, criteria = F.type == OFPMT_OXM, ...)
+
+An expression is a callable which evaluates on a struct as fast as the corresponding lambda: it is
+compiled to a lambda expression on first use. The syntax tree is available in _op and _args, so the
+library can use it:
+
+- a *size* expression like F.length or F.header.length + 8 is inverted to store the real size of the
+  struct when *prepack* is not specified (see Expr._inverse())
+
+- when the *criteria* of all the sub-class types of a base type are equality or membership tests
+  on the same field (F.type == 1, F.type.in_((2, 3))), the sub-class type is found with a dictionary
+  lookup instead of testing the criteria one by one (see Expr._equality())
+
+Use parentheses with & and |, which have a higher precedence than comparisons. An expression cannot
+be converted to bool, use not_(), and_(), or_() instead of not, and, or.
+
+Created on 2026/10/18
+
+:author: hubo
+'''
+from __future__ import absolute_import
+import keyword
+from operator import attrgetter
+
+_IDENTIFIER_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_')
+
+
+def _isidentifier(name):
+    # An ASCII identifier which can be used in an attribute access like x.name
+    return bool(name) and not name[0].isdigit() and all(c in _IDENTIFIER_CHARS for c in name) \
+            and not keyword.iskeyword(name)
+
+
+class Expr(object):
+    '''
+    A node of an expression. Do not create it directly, build expressions from F.
+
+    :ivar _op: 'field' (_args is the property path), 'const' (_args is (value,)), a binary
+               operator like '+' or '==' (_args is (left, right)), 'in' (_args is (expr, values)),
+               'neg', 'not' (_args is (expr,)), 'and', 'or' (_args are the operands)
+
+    :ivar _func: the compiled function, which takes a struct and returns the value
+    '''
+    def __init__(self, op, args):
+        self._op = op
+        self._args = args
+    @property
+    def _func(self):
+        f = self.__dict__.get('_compiled')
+        if f is None:
+            consts = {}
+            f = eval('lambda x: ' + self._source(consts), consts)
+            self._compiled = f
+        return f
+    def _source(self, consts):
+        '''
+        Generate the Python source of the expression, with the parameter *x*. Constants are stored in
+        *consts* and referenced by name.
+        '''
+        op = self._op
+        if op == 'field':
+            if all(_isidentifier(n) for n in self._args):
+                return ''.join(('x',) + tuple('.' + n for n in self._args))
+            name = '_c%d' % (len(consts),)
+            consts[name] = attrgetter('.'.join(self._args))
+            return '%s(x)' % (name,)
+        elif op == 'const' or op == 'in':
+            name = '_c%d' % (len(consts),)
+            if op == 'const':
+                consts[name] = self._args[0]
+                return name
+            consts[name] = self._args[1]
+            return '(%s in %s)' % (self._args[0]._source(consts), name)
+        elif op == 'neg':
+            return '(-%s)' % (self._args[0]._source(consts),)
+        elif op == 'not':
+            return '(not %s)' % (self._args[0]._source(consts),)
+        elif op == 'and' or op == 'or':
+            return '(' + (' %s ' % (op,)).join(a._source(consts) for a in self._args) + ')'
+        else:
+            return '(%s %s %s)' % (self._args[0]._source(consts), op, self._args[1]._source(consts))
+    def __call__(self, obj):
+        return self._func(obj)
+    def __getattr__(self, name):
+        if name.startswith('_') or self._op != 'field':
+            raise AttributeError(name)
+        return _field(self._args + (name,))
+    def __bool__(self):
+        raise TypeError('Expression %r cannot be used as a bool, use &, |, not_(), and_() or or_()' % (self,))
+    __nonzero__ = __bool__
+    __hash__ = object.__hash__
+    def in_(self, values):
+        '''
+        Test whether the value is one of *values*, which must be hashable
+        '''
+        return Expr('in', (self, frozenset(values)))
+    def _fields(self):
+        '''
+        :returns: a set of the property paths used in this expression
+        '''
+        if self._op == 'field':
+            return set([self._args]) if self._args else set()
+        elif self._op == 'const':
+            return set()
+        elif self._op == 'in':
+            return self._args[0]._fields()
+        else:
+            return set().union(*[a._fields() for a in self._args])
+    def _equality(self):
+        '''
+        :returns: (path, values) if the expression tests that a field equals to a constant (F.a == 1),
+                  or is one of the constants (F.a.in_((1, 2))); None else.
+        '''
+        if self._op == '==':
+            left, right = self._args
+            if left._op == 'field' and left._args and right._op == 'const':
+                try:
+                    hash(right._args[0])
+                except TypeError:
+                    return None
+                return (left._args, (right._args[0],))
+        elif self._op == 'in':
+            if self._args[0]._op == 'field' and self._args[0]._args:
+                return (self._args[0]._args, tuple(self._args[1]))
+        return None
+    def _inverse(self):
+        '''
+        Invert an expression of one field, like F.length or F.header.length + 8.
+
+        :returns: (path, func), storing func(v) to the field at *path* makes the expression return v;
+                  None if the expression cannot be inverted.
+        '''
+        if self._op == 'field':
+            return (self._args, lambda v: v) if self._args else None
+        if self._op == 'neg':
+            r = self._args[0]._inverse()
+            if r is None:
+                return None
+            path, f = r
+            return (path, lambda v: f(-v))
+        if self._op not in ('+', '-'):
+            return None
+        left, right = self._args
+        if right._op == 'const' and left._op != 'const':
+            r = left._inverse()
+            c = right._args[0]
+            if r is None:
+                return None
+            path, f = r
+            if self._op == '+':
+                return (path, lambda v: f(v - c))
+            else:
+                return (path, lambda v: f(v + c))
+        elif left._op == 'const' and right._op != 'const':
+            r = right._inverse()
+            c = left._args[0]
+            if r is None:
+                return None
+            path, f = r
+            if self._op == '+':
+                return (path, lambda v: f(v - c))
+            else:
+                return (path, lambda v: f(c - v))
+        return None
+    def __repr__(self, *args, **kwargs):
+        op = self._op
+        if op == 'field':
+            return '.'.join(('F',) + self._args)
+        elif op == 'const':
+            return repr(self._args[0])
+        elif op == 'in':
+            return '%r.in_(%r)' % (self._args[0], tuple(self._args[1]))
+        elif op == 'neg':
+            return '-%r' % (self._args[0],)
+        elif op in ('not', 'and', 'or'):
+            return '%s_(%s)' % (op, ', '.join(repr(a) for a in self._args))
+        else:
+            return '(%r %s %r)' % (self._args[0], op, self._args[1])
+    def __neg__(self):
+        return Expr('neg', (self,))
+
+
+def _field(path):
+    return Expr('field', path)
+
+
+def _expr(value):
+    if isinstance(value, Expr):
+        return value
+    return Expr('const', (value,))
+
+
+def _binary(op, left, right):
+    return Expr(op, (_expr(left), _expr(right)))
+
+
+def _setoperator(name, op, reverse = False):
+    if reverse:
+        setattr(Expr, name, lambda self, other: _binary(op, other, self))
+    else:
+        setattr(Expr, name, lambda self, other: _binary(op, self, other))
+
+
+for _name, _op in (('add', '+'), ('sub', '-'), ('mul', '*'), ('floordiv', '//'), ('mod', '%'),
+                   ('and', '&'), ('or', '|'), ('xor', '^'), ('lshift', '<<'), ('rshift', '>>')):
+    _setoperator('__%s__' % (_name,), _op)
+    _setoperator('__r%s__' % (_name,), _op, True)
+
+for _name, _op in (('eq', '=='), ('ne', '!='), ('lt', '<'), ('le', '<='), ('gt', '>'), ('ge', '>=')):
+    _setoperator('__%s__' % (_name,), _op)
+
+
+def not_(expr):
+    '''
+    Logical not of an expression
+    '''
+    return Expr('not', (_expr(expr),))
+
+
+def and_(*exprs):
+    '''
+    Logical and of expressions, evaluated with short-circuit like *and*
+    '''
+    return Expr('and', tuple(_expr(e) for e in exprs))
+
+
+def or_(*exprs):
+    '''
+    Logical or of expressions, evaluated with short-circuit like *or*
+    '''
+    return Expr('or', tuple(_expr(e) for e in exprs))
+
+
+def _sizeprepack(expr):
+    '''
+    Create a prepack function from a *size* expression, which stores the real size of the struct
+    to the field, like packrealsize().
+
+    :returns: the prepack function, or None if the expression cannot be inverted
+    '''
+    r = expr._inverse()
+    if r is None:
+        return None
+    path, f = r
+    def func(namedstruct):
+        v = namedstruct._target
+        for p in path[:-1]:
+            v = getattr(v, p)
+        setattr(v, path[-1], f(namedstruct._realsize()))
+    return func
+
+
+F = _field(())
+'''
+The root of expressions: F.length is the field "length" of the struct, F.header.length is the
+field "length" of the field "header".
+'''
@@ -0,0 +1,244 @@
+'''
+Memory footprint of parsed structs.
+
+footprint() walks a parsed value (NamedStruct, including embedded structs, sub-classed parts,
+inlined structs, lists and "extra" data) and sums up the memory used by every object with
+sys.getsizeof(). Objects referenced more than once are counted only once. The result is grouped
+by struct type and by field::
+
+    from namedstruct.footprint import footprint, footprint_report
+    print(footprint(ofp_msg.parse(data)[0]))
+    print(footprint_report(ofp_msg, [data1, data2, data3]))
+
+footprint_report() also uses tracemalloc (when available) to count the memory blocks allocated
+by parsing.
+
+Created on 2026/10/18
+
+:author: hubo
+'''
+from __future__ import absolute_import
+import sys
+from namedstruct.namedstruct import NamedStruct, InlineStruct, OrderedDict
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class Footprint(object):
+    '''
+    Result of footprint().
+
+    - *total*: total bytes of all the objects
+    - *types*: {type: [count, bytes]} where bytes are used by the struct objects themselves
+      (the object, its attribute dictionary and internal attributes like "extra" data)
+    - *fields*: {(type, field): bytes} where bytes are the deep size of the field value,
+      excluding the structs which are already counted in *types*
+    '''
+    def __init__(self):
+        self.total = 0
+        self.types = OrderedDict()
+        self.fields = OrderedDict()
+    def merge(self, other):
+        '''
+        Add another footprint result to this result
+        '''
+        self.total += other.total
+        for k,v in other.types.items():
+            c = self.types.setdefault(k, [0, 0])
+            c[0] += v[0]
+            c[1] += v[1]
+        for k,v in other.fields.items():
+            self.fields[k] = self.fields.get(k, 0) + v
+    def format(self, samples = 1):
+        '''
+        :param samples: divide all the values by *samples* to get an average
+
+        :returns: printable report
+        '''
+        lines = ['total: %.1f bytes' % (self.total / float(samples),),
+                 '%-50s %10s %12s' % ('type', 'count', 'bytes')]
+        for k,v in sorted(self.types.items(), key = lambda x: x[1][1], reverse = True):
+            lines.append('%-50s %10.1f %12.1f' % (repr(k), v[0] / float(samples), v[1] / float(samples)))
+        lines.append('%-61s %12s' % ('field', 'bytes'))
+        for k,v in sorted(self.fields.items(), key = lambda x: x[1], reverse = True):
+            lines.append('%-61s %12.1f' % (repr(k[0]) + '.' + k[1], v / float(samples)))
+        return '\n'.join(lines)
+    def __str__(self):
+        return self.format()
+
+
+class _Walker(object):
+    def __init__(self, result):
+        self.result = result
+        self.seen = set()
+    def _size(self, obj):
+        if id(obj) in self.seen:
+            return 0
+        self.seen.add(id(obj))
+        return sys.getsizeof(obj)
+    def structsize(self, s):
+        '''
+        Count a NamedStruct and everything attached to it
+        '''
+        if id(s) in self.seen:
+            return
+        t = s._parser.typedef
+        if t is None:
+            t = s._parser
+        own = self._size(s) + self._size(s.__dict__)
+        for k,v in s.__dict__.items():
+            if k[:1] != '_':
+                continue
+            if k == '_seqs':
+                own += self._size(v)
+                for es in v:
+                    if es is not None:
+                        self.structsize(es)
+            elif k == '_sub':
+                self.structsize(v)
+            elif k == '_embedded_indices':
+                own += self._size(v)
+                for ik, iv in v.items():
+                    own += self._size(iv)
+            elif k == '_extra':
+                own += self._size(v)
+        c = self.result.types.setdefault(t, [0, 0])
+        c[0] += 1
+        c[1] += own
+        self.result.total += own
+        if s._target is s:
+            # Fields are stored in the target struct
+            owner = s._gettype()
+            if owner is None:
+                owner = t
+            for k,v in s.__dict__.items():
+                if k[:1] == '_':
+                    continue
+                size = self.deepsize(v)
+                self.result.fields[(owner, k)] = self.result.fields.get((owner, k), 0) + size
+    def deepsize(self, v):
+        if isinstance(v, NamedStruct):
+            self.structsize(v)
+            return 0
+        size = self._size(v)
+        self.result.total += size
+        if isinstance(v, (list, tuple)):
+            for item in v:
+                size += self.deepsize(item)
+        elif isinstance(v, InlineStruct):
+            dictsize = self._size(v.__dict__)
+            size += dictsize
+            self.result.total += dictsize
+            for k, item in v.__dict__.items():
+                if k[:1] != '_':
+                    size += self.deepsize(item)
+        elif isinstance(v, dict):
+            for k, item in v.items():
+                size += self.deepsize(k)
+                size += self.deepsize(item)
+        return size
+
+
+def footprint(obj, result = None):
+    '''
+    Get the memory footprint of a parsed value.
+
+    :param obj: a NamedStruct, or a value containing NamedStruct (e.g. list)
+
+    :param result: if not None, add the footprint to an existing Footprint object
+
+    :returns: a Footprint object
+    '''
+    if result is None:
+        result = Footprint()
+    w = _Walker(result)
+    w.deepsize(obj)
+    return result
+
+
+class FootprintReport(object):
+    '''
+    Result of footprint_report(). *footprint* is the total Footprint of all samples; *samples* is
+    the number of samples parsed; *blocks* and *allocated* are the number of memory blocks and
+    bytes allocated by parsing and still alive after parsing, counted by tracemalloc (None if
+    tracemalloc is not available); *peak* is the peak traced memory during parsing.
+    '''
+    def __init__(self):
+        self.footprint = Footprint()
+        self.samples = 0
+        self.blocks = None
+        self.allocated = None
+        self.peak = None
+    def format(self):
+        '''
+        :returns: printable report, values are averages of the samples
+        '''
+        samples = max(self.samples, 1)
+        lines = ['samples: %d' % (self.samples,)]
+        if self.blocks is not None:
+            lines.append('allocated blocks: %.1f, allocated bytes: %.1f, peak: %d' %
+                         (self.blocks / float(samples), self.allocated / float(samples), self.peak))
+        lines.append(self.footprint.format(samples))
+        return '\n'.join(lines)
+    def __str__(self):
+        return self.format()
+
+
+def footprint_report(typedef, sample_buffers, create = False, usetracemalloc = True):
+    '''
+    Parse every sample with the type and report the average memory usage.
+
+    :param typedef: the type to parse
+
+    :param sample_buffers: a sequence of bytes
+
+    :param create: use create() instead of parse()
+
+    :param usetracemalloc: if True and tracemalloc is available, count the allocations with tracemalloc.
+                           tracemalloc slows down parsing, but it does not affect the results.
+
+    :returns: a FootprintReport object
+    '''
+    report = FootprintReport()
+    parser = typedef.parser()
+    trace = usetracemalloc and tracemalloc is not None
+    started = False
+    if trace:
+        _filters = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        report.blocks = 0
+        report.allocated = 0
+        report.peak = 0
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started = True
+    try:
+        for b in sample_buffers:
+            if trace:
+                before = tracemalloc.take_snapshot().filter_traces(_filters)
+                if hasattr(tracemalloc, 'reset_peak'):
+                    tracemalloc.reset_peak()
+                current, _ = tracemalloc.get_traced_memory()
+            if create:
+                r = parser.create(b)
+            else:
+                r = parser.parse(b)
+                if r is not None:
+                    r = r[0]
+            if trace:
+                _, peak = tracemalloc.get_traced_memory()
+                after = tracemalloc.take_snapshot().filter_traces(_filters)
+                for stat in after.compare_to(before, 'filename'):
+                    report.blocks += stat.count_diff
+                    report.allocated += stat.size_diff
+                report.peak = max(report.peak, peak - current)
+                del before, after
+            if r is not None:
+                footprint(r, report.footprint)
+                report.samples += 1
+    finally:
+        if started:
+            tracemalloc.stop()
+    return report
@@ -5,9 +5,11 @@ Created on 2015/7/8
 '''
 from __future__ import print_function, absolute_import, division 
 import struct
-import logging
+from operator import itemgetter
 import warnings
+import threading
 from io import BytesIO
+from namedstruct.expr import Expr, _field, _sizeprepack
 try:
     from collections import OrderedDict as OrderedDict
 except Exception:
@@ -15,6 +17,10 @@ except Exception:
     OrderedDict = dict
 else:
     _has_ordered_dict = True
+try:
+    from collections.abc import MutableSequence
+except ImportError:
+    from collections import MutableSequence
 
 class ParseError(ValueError):
     '''
@@ -40,6 +46,16 @@ def _set(obj, name, value):
 
 _deprecated_parsers = set()
 
+# Field name of an anonymous fixed size member (a FormatParser) flattened into a SequencedParser: the
+# fields are unpacked into the parent directly, and a None placeholder is stored in _seqs. An
+# EmbeddedStruct is created only when it is really needed (see _embeddedstruct)
+_FLATTEN = object()
+
+# Serialize parser compiling and type registration. Re-entrant because compiling a type compiles its
+# members and base types. Dispatch tables (subclasses, subindices, pickle types) are never modified
+# in place: a modified copy is published instead, so readers do not need the lock.
+_compile_lock = threading.RLock()
+
 
 def _tostream(parser, obj, stream, skipprepack = False):
     """
@@ -51,11 +67,68 @@ def _tostream(parser, obj, stream, skipprepack = False):
         data = parser.tobytes(obj, skipprepack)
         cls = type(parser)
         if cls not in _deprecated_parsers:
-            _deprecated_parsers.add(cls)
+            with _compile_lock:
+                if cls in _deprecated_parsers:
+                    return stream.write(data)
+                _deprecated_parsers.add(cls)
             warnings.warn("Parser %r does not have 'tostream' interfaces" % (cls,), UserWarning)
         return stream.write(data)
 
 
+def _packpieces(parser, value):
+    """
+    Pack a value piece by piece for NamedStruct._iterbytes(). Prepack must be executed before.
+    
+    :returns: an iterable of bytes
+    """
+    if isinstance(value, NamedStruct):
+        return value._iterpieces()
+    stream = BytesIO()
+    _tostream(parser, value, stream, True)
+    return (stream.getvalue(),)
+
+
+class _BufferCollector(object):
+    '''
+    Write-only stream for NamedStruct._tobuffers(). Small writes are merged; large writes are kept
+    by reference.
+    '''
+    def __init__(self, minsize):
+        self.minsize = minsize
+        self.buffers = []
+        self.current = bytearray()
+    def _flush(self):
+        if self.current:
+            self.buffers.append(bytes(self.current))
+            self.current = bytearray()
+    def write(self, data):
+        size = len(data)
+        if size >= self.minsize:
+            self._flush()
+            self.buffers.append(data)
+        elif size:
+            self.current += data
+        return size
+    def getbuffers(self):
+        self._flush()
+        return self.buffers
+
+
+class _lazylogger(object):
+    '''
+    A logger which is created on first access. logging is not imported until it is really used,
+    which saves import time of the module.
+    '''
+    def __init__(self, name):
+        self.name = name
+    def __get__(self, obj, cls = None):
+        import logging
+        return logging.getLogger(self.name)
+
+def _formattererror():
+    import logging
+    NamedStruct._logger.log(logging.DEBUG, 'A formatter thrown an exception', exc_info = True)
+
 class NamedStruct(object):
     '''
     Store a binary struct message, which is serializable.
@@ -67,7 +140,7 @@ class NamedStruct(object):
     '''
     _pickleTypes = {}
     _pickleNames = {}
-    _logger = logging.getLogger(__name__ + '.NamedStruct')
+    _logger = _lazylogger(__name__ + '.NamedStruct')
     def __init__(self, parser):
         '''
         Constructor. Usually a NamedStruct is constructed automatically by a parser, you should not call
@@ -99,7 +172,7 @@ class NamedStruct(object):
             data = current._parser.unpack(data, current)
             last = current
             current = getattr(current, '_sub', None)
-        _set(last, '_extra', data)
+        _set(last, '_extra', _payload(data))
     def _pack(self):
         '''
         Pack current struct into bytes. For parser internal use.
@@ -154,6 +227,76 @@ class NamedStruct(object):
         stream = BytesIO()
         self._tostream(stream, skipprepack)
         return stream.getvalue()
+    def _tobuffers(self, skipprepack = False, minsize = 512):
+        '''
+        Convert the struct to a list of buffers for scatter-gather output (socket.sendmsg, os.writev).
+        Data written by the parsers is merged into bytes, except that large payloads (e.g. raw data and
+        "extra" data) are put into the list as they are, without copying.
+        
+        :param skipprepack: if True, the prepack stage is skipped. For parser internal use.
+        
+        :param minsize: payloads at least *minsize* bytes long are not copied
+        
+        :returns: a list of bytes-like objects, b''.join() of them is the same as _tobytes()
+        '''
+        stream = _BufferCollector(minsize)
+        self._tostream(stream, skipprepack)
+        return stream.getbuffers()
+    def _iterbytes(self, chunk_size = 65536, skipprepack = False):
+        '''
+        Convert the struct to bytes incrementally. Array elements (and their fields) are packed one
+        by one when the chunks are consumed, so a very large message (e.g. a multipart reply with
+        millions of entries) is never packed into memory as a whole.
+        
+        The prepack stage is executed on the whole struct before the first chunk is generated; the
+        struct should not be modified until all the chunks are consumed.
+        
+        :param chunk_size: size of the generated chunks; the last chunk may be smaller.
+        
+        :param skipprepack: if True, the prepack stage is skipped.
+        
+        :returns: an iterator of bytes, b''.join() of them is the same as _tobytes()
+        '''
+        if not skipprepack:
+            self._prepack()
+        chunk = bytearray()
+        for piece in self._iterpieces():
+            chunk += piece
+            if len(chunk) >= chunk_size:
+                start = 0
+                while len(chunk) - start >= chunk_size:
+                    yield bytes(chunk[start:start + chunk_size])
+                    start += chunk_size
+                del chunk[:start]
+        if chunk:
+            yield bytes(chunk)
+    def _iterpieces(self):
+        '''
+        Generate packed bytes of a prepacked struct piece by piece, for _iterbytes() internal use.
+        Parsers with a "packiter" method generate their pieces themselves; other parsers pack
+        their part at once.
+        '''
+        datasize = 0
+        current = self
+        while current is not None:
+            parser = current._parser
+            if hasattr(parser, 'packiter'):
+                pieces = parser.packiter(current)
+            else:
+                stream = BytesIO()
+                parser.packto(current, stream)
+                pieces = (stream.getvalue(),)
+            for piece in pieces:
+                datasize += len(piece)
+                yield piece
+            last = current
+            current = getattr(current, '_sub', None)
+        if hasattr(last, '_extra'):
+            datasize += len(last._extra)
+            yield last._extra
+        paddingSize = self._parser.paddingsize2(datasize)
+        if paddingSize > datasize:
+            yield b'\x00' * (paddingSize - datasize)
     def _tostream(self, stream, skipprepack= False):
         '''
         Convert the struct into a bytes stream. This is the standard way to convert a NamedStruct to bytes.
@@ -277,14 +420,55 @@ class NamedStruct(object):
                         
     def __copy__(self):
         '''
-        Create a copy of the struct. It is always a deepcopy, in fact it packs the struct and unpack it again.
+        Create a copy of the struct. It is always a deepcopy, see _clone()
         '''
-        return self._parser.create(memoryview(self._tobytes()), None)
+        return self._clone()
     def __deepcopy__(self, memo):
         '''
         Create a copy of the struct.
         '''
-        return self._parser.create(memoryview(self._tobytes()), None)
+        return self._clone()
+    def _clone(self):
+        '''
+        Create a copy of the struct by copying the fields directly, without packing and parsing
+        again. The copy has the same sub-class types and embedded struct types, and prepack is not
+        executed. Lists, inlined structs and NamedStruct field values are copied; other values
+        (integers, bytes) are immutable and shared.
+        
+        An embedded struct is copied as a standalone struct by packing and parsing.
+        
+        :returns: a new struct
+        '''
+        if self._target is not self:
+            return self._parser.create(memoryview(self._tobytes()), None)
+        memo = {}
+        c = self._clonestruct(None, memo)
+        if '_embedded_indices' in c.__dict__:
+            c.__dict__['_embedded_indices'] = dict((k, (memo.get(id(es), es), i))
+                                                   for k, (es, i) in self._embedded_indices.items())
+        return c
+    def _clonestruct(self, target, memo):
+        '''
+        Copy this struct (and embedded structs, sub-class structs) into target. For _clone() internal use.
+        '''
+        cls = type(self)
+        c = cls.__new__(cls)
+        memo[id(self)] = c
+        if target is None:
+            target = c
+        d = c.__dict__
+        for k,v in self.__dict__.items():
+            if k == '_target':
+                d[k] = target
+            elif k == '_seqs':
+                d[k] = [None if es is None else es._clonestruct(target, memo) for es in v]
+            elif k == '_sub':
+                d[k] = v._clonestruct(target, memo)
+            elif k[:1] == '_':
+                d[k] = v
+            else:
+                d[k] = _clonevalue(v, target)
+        return c
     def __repr__(self, *args, **kwargs):
         '''
         Return the representation of the struct.
@@ -300,8 +484,9 @@ class NamedStruct(object):
         transfered with the type information. Actually it transfers the packed bytes and the type name.
         '''
         t = self._parser.typedef
-        if t is not None and t in NamedStruct._pickleNames:
-            return (self._tobytes(), NamedStruct._pickleNames[t], self._target)
+        name = None if t is None else NamedStruct._pickleNames.get(t)
+        if name is not None:
+            return (self._tobytes(), name, self._target)
         else:
             return (self._tobytes(), self._parser, self._target)
     def __setstate__(self, state):
@@ -311,8 +496,9 @@ class NamedStruct(object):
         if not isinstance(state, tuple):
             raise ValueError('State should be a tuple')
         t = state[1]
-        if t in NamedStruct._pickleTypes:
-            parser = NamedStruct._pickleTypes[t].parser()
+        pickletype = NamedStruct._pickleTypes.get(t)
+        if pickletype is not None:
+            parser = pickletype.parser()
         else:
             parser = t
         if state[2] is not self:
@@ -349,15 +535,24 @@ class NamedStruct(object):
         if hasattr(name, 'readablename'):
             name = name.readablename
         t,i = self._target._embedded_indices[name]
-        return t._seqs[i]        
+        es = t._seqs[i]
+        if es is None:
+            es = _embeddedstruct(t, i)
+            t._seqs[i] = es
+        return es
     @staticmethod
     def _registerPickleType(name, typedef):
         '''
         Register a type with the specified name. After registration, NamedStruct with this type
         (and any sub-types) can be successfully pickled and transfered.
         '''
-        NamedStruct._pickleNames[typedef] = name
-        NamedStruct._pickleTypes[name] = typedef
+        with _compile_lock:
+            pickleNames = dict(NamedStruct._pickleNames)
+            pickleNames[typedef] = name
+            pickleTypes = dict(NamedStruct._pickleTypes)
+            pickleTypes[name] = typedef
+            NamedStruct._pickleNames = pickleNames
+            NamedStruct._pickleTypes = pickleTypes
 
 class EmbeddedStruct(NamedStruct):
     def __init__(self, parser, inlineparent):
@@ -391,13 +586,101 @@ class EmbeddedStruct(NamedStruct):
             object.__delattr__(self, name)
         
 
+COMPARE_BYTES = 'bytes'
+COMPARE_FIELDS = 'fields'
+
+class ValueStruct(NamedStruct):
+    '''
+    A NamedStruct which is compared and hashed by value instead of identity, see typedef.set_compare().
+    The compare key and the hash value are cached, and cleared when a field of the struct (or an embedded
+    struct) is set or deleted, or the struct is changed with _setextra(), _autosubclass() or
+    _replace_embedded_type(). Modifying a list or a nested struct in place does not clear the cache: call
+    _rehash() after such modifications, and do not modify a struct in place while it is used as a
+    dictionary key.
+    '''
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name[:1] != '_':
+            self.__dict__.pop('_valuecache', None)
+    def __delattr__(self, name):
+        object.__delattr__(self, name)
+        if name[:1] != '_':
+            self.__dict__.pop('_valuecache', None)
+    def _rehash(self):
+        '''
+        Clear the cached compare key and hash value, after the struct is modified in place.
+        '''
+        self.__dict__.pop('_valuecache', None)
+    def _setextra(self, extradata):
+        NamedStruct._setextra(self, extradata)
+        self._rehash()
+    def _subclass(self, parser):
+        NamedStruct._subclass(self, parser)
+        self._rehash()
+    def _extend(self, newsub):
+        NamedStruct._extend(self, newsub)
+        self._rehash()
+    def _replace_embedded_type(self, name, newtype):
+        NamedStruct._replace_embedded_type(self, name, newtype)
+        self._rehash()
+    def _cachedvalue(self):
+        # (compare key, hash value)
+        c = self.__dict__.get('_valuecache')
+        if c is None:
+            if self._parser.comparemode == COMPARE_FIELDS:
+                key = (self._gettype(), _freeze(dump(self, False, True, DUMPTYPE_NONE, False)))
+            else:
+                # prepack is executed on a copy, so comparing does not modify the struct
+                key = (self._getbasetype(), self._clone()._tobytes())
+            c = (key, hash(key))
+            _set(self, '_valuecache', c)
+        return c
+    def _valuekey(self):
+        '''
+        :returns: a hashable value used to compare the struct, depending on the compare mode of the type
+        '''
+        return self._cachedvalue()[0]
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, ValueStruct):
+            return NotImplemented
+        return self._valuekey() == other._valuekey()
+    def __ne__(self, other):
+        r = self.__eq__(other)
+        if r is NotImplemented:
+            return r
+        return not r
+    def __hash__(self):
+        return self._cachedvalue()[1]
+
+def _freeze(v):
+    '''
+    Convert a dump() result to a hashable value
+    '''
+    if isinstance(v, dict):
+        return tuple(sorted((k, _freeze(v2)) for k,v2 in v.items()))
+    elif isinstance(v, list):
+        return tuple(_freeze(v2) for v2 in v)
+    else:
+        return v
+
 def _create_struct(parser, inlineparent = None):
     if inlineparent is None:
-        r = NamedStruct(parser)
+        r = parser.structclass(parser)
     else:
         r = EmbeddedStruct(parser, inlineparent)
     r._create_embedded_indices()
     return r
+
+def _embeddedstruct(s, i):
+    '''
+    Return the i-th embedded struct of s, creating an EmbeddedStruct for a flattened member
+    '''
+    es = s._seqs[i]
+    if es is None:
+        es = s._parser.embeddedparsers[i].embedded(s._target)
+    return es
     
 DUMPTYPE_FLAT = 'flat'
 DUMPTYPE_KEY = 'key'
@@ -454,6 +737,13 @@ def dump(val, humanread = True, dumpextra = False, typeinfo = DUMPTYPE_FLAT, ord
     
     :returns: "dump" format of val, suitable for JSON-encode or print.
     '''
+    return _dumpvalue(val, humanread, dumpextra, typeinfo, ordered, tostr, encoding)
+
+
+def _dumpvalue(val, humanread, dumpextra, typeinfo, ordered, tostr, encoding):
+    '''
+    Implementation of dump(). It is looked up as a module global, so instrumentation may replace it.
+    '''
     dumped = _dump(val, humanread, dumpextra, typeinfo, ordered)
     if tostr:
         dumped = _to_str(dumped, encoding, ordered)
@@ -477,13 +767,15 @@ def _dump(val, humanread = True, dumpextra = False, typeinfo = DUMPTYPE_FLAT, or
                     try:
                         r = t.extraformatter(r)
                     except:
-                        NamedStruct._logger.log(logging.DEBUG, 'A formatter thrown an exception', exc_info = True)
+                        _formattererror()
             else:
                 r = dict((k, _dump(v, humanread, dumpextra, typeinfo)) for k, v in val.__dict__.items() if k[:1] != '_')
                 if ordered:
                     r = t.reorderdump(r, val)
         if dumpextra:
             extra = val._getextra()
+            if isinstance(extra, memoryview):
+                extra = extra.tobytes()
             if extra:
                 try:
                     r['_extra'] = extra
@@ -500,8 +792,10 @@ def _dump(val, humanread = True, dumpextra = False, typeinfo = DUMPTYPE_FLAT, or
         return r
     elif isinstance(val, InlineStruct):
         return dict((k, _dump(v, humanread, dumpextra, typeinfo)) for k, v in val.__dict__.items() if k[:1] != '_')
-    elif isinstance(val, list) or isinstance(val, tuple):
+    elif isinstance(val, list) or isinstance(val, tuple) or isinstance(val, LazyList):
         return [_dump(v, humanread, dumpextra, typeinfo) for v in val]
+    elif isinstance(val, memoryview):
+        return val.tobytes()
     else:
         return val
 
@@ -516,6 +810,96 @@ def _copy(buffer):
         return buffer[:]
 
 
+def _asbytes(buffer):
+    # Bytes of a payload, which may be a memoryview in zerocopy mode. bytes(memoryview) does not
+    # work in Python 2
+    if isinstance(buffer, memoryview):
+        return buffer.tobytes()
+    return buffer
+
+
+_zerocopy = threading.local()
+
+
+def _payload(buffer):
+    '''
+    Bytes stored in a parsed struct (raw data, C-strings and "extra" data). In zerocopy mode,
+    memoryview slices are stored as they are.
+    '''
+    if isinstance(buffer, memoryview) and getattr(_zerocopy, 'enabled', False):
+        return buffer
+    return _copy(buffer)
+
+
+class zerocopy(object):
+    '''
+    Context manager to parse in zero-copy mode in the current thread::
+    
+        with zerocopy():
+            packet = ofp_msg.create(memoryview(data))
+    
+    In zero-copy mode, raw data (raw, varchr), C-strings (cstr) and "extra" data parsed from a
+    memoryview are stored as memoryview slices of the source buffer instead of bytes copies, so
+    large payloads are not copied when they are only forwarded or hashed. Bytes inputs are not affected.
+    
+    The parsed struct references the source buffer: the buffer must not be modified while the struct
+    is used. Use materialize() to keep the struct longer than the buffer. Modes may be nested.
+    '''
+    def __init__(self, enabled = True):
+        '''
+        :param enabled: False to temporarily disable zero-copy mode inside a zero-copy block
+        '''
+        self.enabled = enabled
+    def __enter__(self):
+        self._previous = getattr(_zerocopy, 'enabled', False)
+        _zerocopy.enabled = self.enabled
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        _zerocopy.enabled = self._previous
+        return False
+
+
+def materialize(val):
+    '''
+    Replace the memoryview values in a parsed value (created in zero-copy mode) with bytes copies,
+    so it does not reference the source buffer any more. NamedStruct (including embedded and
+    sub-class parts), inlined structs and lists are modified in place.
+    
+    :param val: parsed result, may contain NamedStruct
+    
+    :returns: *val* itself, or a bytes copy if *val* is a memoryview
+    '''
+    if isinstance(val, memoryview):
+        return val.tobytes()
+    elif isinstance(val, NamedStruct):
+        d = val.__dict__
+        for k,v in list(d.items()):
+            if k == '_seqs':
+                for es in v:
+                    if es is not None:
+                        materialize(es)
+            elif k == '_sub':
+                materialize(v)
+            elif k == '_extra' or k[:1] != '_':
+                d[k] = materialize(v)
+    elif isinstance(val, InlineStruct):
+        d = val.__dict__
+        for k,v in list(d.items()):
+            if k[:1] != '_':
+                d[k] = materialize(v)
+    elif isinstance(val, list):
+        for i in range(0, len(val)):
+            val[i] = materialize(val[i])
+    elif isinstance(val, tuple):
+        return tuple(materialize(v) for v in val)
+    elif isinstance(val, LazyList):
+        val._buffer = materialize(val._buffer)
+        for item in val._items:
+            if item is not None:
+                materialize(item)
+    return val
+
+
 def sizefromlen(limit, *properties):
     '''
     Factory to generate a function which get size from specified field with limits.
@@ -622,6 +1006,53 @@ class InlineStruct(object):
         return repr(dict((k,v) for k,v in self.__dict__.items() if k[:1] != '_'))
 
 
+def _prototype(obj):
+    '''
+    Get the field values stored in obj as a prototype dictionary for _setprototype. Inlined structs
+    are stored as nested dictionaries.
+    '''
+    return dict((k, _prototype(v) if isinstance(v, InlineStruct) else v)
+                for k,v in obj.__dict__.items() if k[:1] != '_')
+
+def _setprototype(t, prototype, parent):
+    '''
+    Copy the field values from a prototype dictionary to t. Lists and inlined structs are copied,
+    so they are not shared between structs.
+    '''
+    d = t.__dict__
+    for k,v in prototype.items():
+        if type(v) is list:
+            d[k] = v[:]
+        elif type(v) is dict:
+            v2 = d.get(k)
+            if not isinstance(v2, InlineStruct):
+                v2 = InlineStruct(parent)
+                d[k] = v2
+            _setprototype(v2, v, parent)
+        else:
+            d[k] = v
+
+
+def _clonevalue(v, parent):
+    '''
+    Copy a field value for NamedStruct._clone()
+    '''
+    if isinstance(v, NamedStruct):
+        return v._clone()
+    elif isinstance(v, list):
+        return [_clonevalue(v2, parent) for v2 in v]
+    elif isinstance(v, LazyList):
+        return v._clone()
+    elif isinstance(v, InlineStruct):
+        c = InlineStruct(parent)
+        for k,v2 in v.__dict__.items():
+            if k[:1] != '_':
+                c.__dict__[k] = _clonevalue(v2, parent)
+        return c
+    else:
+        return v
+
+
 def _never(namedstruct):
     return False
 
@@ -630,7 +1061,10 @@ class Parser(object):
     Base class for many struct parsers (not every though). End user should not call interfaces of a parser.
     Call interfaces of the typedef instead.
     '''
-    logger = logging.getLogger(__name__ + '.Parser')
+    logger = _lazylogger(__name__ + '.Parser')
+    # Class of the created structs and the compare mode, see typedef.set_compare()
+    structclass = NamedStruct
+    comparemode = None
     def __init__(self, base = None, criteria = _never, padding = 8, initfunc = None, typedef = None, classifier = None, classifyby = None,
                  prepackfunc = None):
         '''
@@ -657,17 +1091,40 @@ class Parser(object):
         self.subclasses = []
         self.subindices = {}
         self.base = base
+        # Free list of released structs, see typedef.set_freelist()
+        self.freelist = None
+        self.freelistsize = 0
         self.padding = padding
         self.isinstance = criteria
         self.initfunc = initfunc
         self.typedef = typedef
         self.classifier = classifier
+        self.classifyby = classifyby
         self.prepackfunc = prepackfunc
-        if self.base is not None:
-            self.base.subclasses.append(self)
-            if classifyby is not None:
-                for v in classifyby:
-                    self.base.subindices[v] = self
+        self._registered = False
+        if typedef is None:
+            self._register()
+    def _register(self):
+        '''
+        Register this parser in the base parser. Parsers of types are registered by typedef.parser() after
+        they are completely constructed, so other threads never find a partially constructed parser.
+        '''
+        if self.base is None or self._registered:
+            return
+        with _compile_lock:
+            if self._registered:
+                return
+            self.base.subclasses = self.base.subclasses + [self]
+            self.base.flat = False
+            if self.classifyby is not None:
+                registered = getattr(self.base.typedef, 'subindices', None)
+                subindices = dict(self.base.subindices)
+                for v in self.classifyby:
+                    # Do not replace a sub-class type defined later with the same value
+                    if registered is None or registered.get(v, self.typedef) is self.typedef:
+                        subindices[v] = self
+                self.base.subindices = subindices
+            self._registered = True
     def parse(self, buffer, inlineparent = None):
         '''
         Try to parse the struct from bytes sequence. The bytes sequence is taken from a streaming source.
@@ -701,21 +1158,48 @@ class Parser(object):
                 cs = cs._sub
                 cp = cs._parser
                 continue
-            subp = None
-            clsfr = getattr(cp, 'classifier', None)
-            if clsfr is not None:
-                clsvalue = clsfr(namedstruct)
-                subp = cp.subindices.get(clsvalue)
-            if subp is None:
-                for sc in cp.subclasses:
-                    if sc.isinstance(namedstruct):
-                        subp = sc
-                        break
+            subp = cp._findsubclass(namedstruct)
             if subp is None:
                 break
             cs._subclass(subp)
             cs = cs._sub
             cp = subp
+    def _findsubclass(self, namedstruct):
+        '''
+        Find the sub-class parser which matches the struct. Sub-class types are registered in the
+        typedef, and their parsers are compiled the first time they are selected.
+        
+        :param namedstruct: a NamedStruct of this type.
+        
+        :returns: the sub-class parser, or None if no sub-class matches.
+        '''
+        clsfr = getattr(self, 'classifier', None)
+        if clsfr is not None:
+            clsvalue = clsfr(namedstruct)
+            subp = self.subindices.get(clsvalue)
+            if subp is not None:
+                return subp
+            subtype = getattr(self.typedef, 'subindices', {}).get(clsvalue)
+            if subtype is not None:
+                return subtype.parser()
+        subtypes = getattr(self.typedef, 'subclasses', None)
+        if subtypes is None:
+            for sc in self.subclasses:
+                if sc.isinstance(namedstruct):
+                    return sc
+        else:
+            index = getattr(self.typedef, 'criteriaindex', None)
+            if index is not None:
+                try:
+                    subtype = index[1].get(index[0](namedstruct))
+                except TypeError:
+                    # Unhashable value
+                    subtype = None
+                return None if subtype is None else subtype.parser()
+            for t in subtypes:
+                if t.criteria(namedstruct):
+                    return t.parser()
+        return None
     def _parse(self, buffer, inlineparent):
         '''
         Internal interface to parse from some data. Different from parse(), this interface returns "real" size
@@ -730,6 +1214,60 @@ class Parser(object):
                 and size is the REAL SIZE of the struct.
         '''
         raise NotImplementedError
+    def _parsestruct(self, buffer, namedstruct):
+        '''
+        Internal interface to parse from some data into an existing struct of this parser, used by parseinto().
+        
+        :returns: None if the buffer does not have enough data for this struct; the REAL SIZE of the struct else.
+        '''
+        return self._parseinner(buffer, namedstruct)
+    def _clearstruct(self, namedstruct):
+        '''
+        Remove all the fields and sub-class parts from a struct before parsing into it again.
+        '''
+        d = namedstruct.__dict__
+        parser = d['_parser']
+        d.clear()
+        d['_parser'] = parser
+        d['_target'] = namedstruct
+        namedstruct._create_embedded_indices()
+    def parseinto(self, namedstruct, buffer):
+        '''
+        Same as parse(), but parse into an existing struct instead of creating a new one.
+        
+        :param namedstruct: a struct created by this parser (not an embedded struct), or None to use a
+                            struct from the free list, or create a new one.
+        
+        :param buffer: bytes sequence to be parsed from.
+        
+        :returns: None if the buffer does not have enough data for this struct; (struct, size) else.
+        '''
+        if self.base is not None:
+            return self.base.parseinto(namedstruct, buffer)
+        if namedstruct is None:
+            try:
+                namedstruct = self.freelist.pop()
+            except (AttributeError, IndexError):
+                namedstruct = _create_struct(self)
+        elif namedstruct._parser is not self or namedstruct._target is not namedstruct:
+            raise ValueError('%r is not a struct created by %r' % (namedstruct, self.typedef))
+        self._clearstruct(namedstruct)
+        size = self._parsestruct(buffer, namedstruct)
+        if size is None:
+            return None
+        self.subclass(namedstruct)
+        return (namedstruct, (size + self.padding - 1) // self.padding * self.padding)
+    def release(self, namedstruct):
+        '''
+        Put a struct created by this parser into the free list, if the free list is enabled and not full.
+        '''
+        if self.base is not None:
+            return self.base.release(namedstruct)
+        if namedstruct._parser is not self or namedstruct._target is not namedstruct:
+            raise ValueError('%r is not a struct created by %r' % (namedstruct, self.typedef))
+        freelist = self.freelist
+        if freelist is not None and len(freelist) < self.freelistsize:
+            freelist.append(namedstruct)
     def new(self, inlineparent = None):
         '''
         Create an empty struct of this type. "initfunc" is called on the created struct to initialize it.
@@ -791,6 +1329,19 @@ class Parser(object):
         if self.base is not None:
             return self.base.paddingsize2(realsize)
         return (realsize + self.padding - 1) // self.padding * self.padding
+    @property
+    def staticsize(self):
+        '''
+        The padded size of every value of this type if it is a constant, or None if the size depends
+        on the value. Values with "extra" data are not considered.
+        '''
+        return None
+    def _fixedlayout(self):
+        '''
+        True if the struct cannot be sub-classed or resized, so the size depends only on the fields
+        '''
+        return self.base is None and getattr(self, 'sizefunc', None) is None and self.classifier is None \
+                and not self.subclasses and not getattr(self.typedef, 'subclasses', None)
     def tobytes(self, namedstruct, skipprepack = False):
         '''
         Convert a NamedStruct to packed bytes.
@@ -838,6 +1389,134 @@ class Parser(object):
         value._prepack()
 
 
+def _formatcodes(fmt):
+    '''
+    Split a struct format into format codes.
+
+    :returns: a list of (endian, code) tuples, endian is '' if the code is not marked with an endian;
+              None if fmt is not recognized.
+    '''
+    codes = []
+    i = 0
+    n = len(fmt)
+    while i < n:
+        endian = ''
+        if fmt[i] in '<>!=@':
+            endian = fmt[i]
+            i += 1
+        start = i
+        while i < n and fmt[i].isspace():
+            i += 1
+        while i < n and fmt[i].isdigit():
+            i += 1
+        if i >= n or not (fmt[i].isalpha() or fmt[i] == '?'):
+            return None
+        i += 1
+        while i < n and fmt[i].isspace():
+            i += 1
+        codes.append((endian, fmt[start:i]))
+    return codes
+
+
+def _endianformat(endian, fmt):
+    '''
+    Mark every format code in fmt with an endian, so the codes keep this endian when they are inlined
+    into a struct with a different endian.
+    '''
+    codes = _formatcodes(fmt)
+    if codes is None:
+        # Not a recognized format, let struct report the error
+        return fmt
+    return ''.join(endian + c for _, c in codes)
+
+
+class _MixedStruct(object):
+    '''
+    A struct.Struct compatible object for a format with fields of different endians. The format is split
+    into groups of the same endian. Fields of each endian are unpacked with one call (skipping bytes of
+    other endians), then re-ordered; packing is done group by group.
+    '''
+    def __init__(self, groups):
+        self.groups = []
+        offset = 0
+        count = 0
+        for endian, fmt in groups:
+            s = struct.Struct(endian + fmt)
+            n = len(s.unpack(b'\x00' * s.size))
+            self.groups.append((s, offset, count, count + n))
+            offset += s.size
+            count += n
+        self.size = offset
+        self.format = ''.join(e + f for e, f in groups)
+        endians = []
+        for e, _ in groups:
+            if e not in endians:
+                endians.append(e)
+        if count > 1 and '@' not in endians:
+            self.unpackers = []
+            positions = [None] * count
+            start = 0
+            for e in endians:
+                fmt = []
+                for (ge, gf), (s, _, begin, end) in zip(groups, self.groups):
+                    if ge == e:
+                        fmt.append(gf)
+                        for i in range(begin, end):
+                            positions[i] = start
+                            start += 1
+                    else:
+                        fmt.append('%dx' % (s.size,))
+                self.unpackers.append(struct.Struct(e + ''.join(fmt)).unpack_from)
+            self.reorder = itemgetter(*positions)
+            if len(self.unpackers) == 2:
+                # The usual case of two endians
+                unpack1, unpack2 = self.unpackers
+                reorder = self.reorder
+                self.unpack_from = lambda buffer, offset = 0: reorder(unpack1(buffer, offset) + unpack2(buffer, offset))
+        else:
+            # Native alignment changes the offsets of skipped bytes
+            self.unpackers = None
+    def unpack(self, buffer):
+        if len(buffer) != self.size:
+            raise struct.error('unpack requires a buffer of %d bytes' % (self.size,))
+        return self.unpack_from(buffer, 0)
+    def unpack_from(self, buffer, offset = 0):
+        if self.unpackers is not None:
+            result = ()
+            for u in self.unpackers:
+                result += u(buffer, offset)
+            return self.reorder(result)
+        result = ()
+        for s, start, _, _ in self.groups:
+            result += s.unpack_from(buffer, offset + start)
+        return result
+    def pack(self, *args):
+        return b''.join([s.pack(*args[start:end]) for s, _, start, end in self.groups])
+
+
+def _mkstruct(endian, fmt):
+    '''
+    Create a struct.Struct for fmt with the default endian. Format codes marked with another endian
+    (see _endianformat) are unpacked with their own endian.
+    '''
+    if not any(c in fmt for c in '<>!=@'):
+        return struct.Struct(endian + fmt)
+    codes = _formatcodes(fmt)
+    if codes is None:
+        # Not a recognized format, let struct report the error
+        return struct.Struct(endian + fmt)
+    groups = []
+    for e, c in codes:
+        e = e or endian
+        if groups and groups[-1][0] == e:
+            groups[-1][1].append(c)
+        else:
+            groups.append((e, [c]))
+    if len(groups) == 1:
+        return struct.Struct(groups[0][0] + ''.join(groups[0][1]))
+    return _MixedStruct([(e, ''.join(f)) for e, f in groups])
+
+
 class FormatParser(Parser):
     '''
     Parsing or serializing a NamedStruct with format specified with "struct" library format.
@@ -875,35 +1554,60 @@ class FormatParser(Parser):
         :param classifyby: see Parser.__init__
         '''
         Parser.__init__(self, base, criteria, padding, initfunc, typedef, classifier, classifyby, prepackfunc)
-        self.struct = struct.Struct(endian + fmt)
+        self.struct = _mkstruct(endian, fmt)
         self.properties = properties
         self.emptydata = b'\x00' * self.struct.size
+        self.empty = self.struct.unpack(self.emptydata)
         self.sizefunc = sizefunc
+        # Field values of an empty struct, copied by new() instead of unpacking empty data every time
+        proto = InlineStruct(None)
+        self._setproperties(self.empty, proto)
+        self.prototype = _prototype(proto)
+        # An anonymous member of this type can be flattened into a sequenced parent
+        self.flat = self._fixedlayout() and self.paddingsize2(self.struct.size) == self.struct.size
     def _parse(self, buffer, inlineparent = None):
         if len(buffer) < self.struct.size:
             return None
         s = _create_struct(self, inlineparent)
-        self.unpack(buffer[0:self.struct.size], s)
+        size = self._parsestruct(buffer, s)
+        if size is None:
+            return None
+        return (s, size)
+    def _parsestruct(self, buffer, namedstruct):
+        s = namedstruct
+        if self.unpackfrom(buffer, 0, s._target) is None:
+            return None
         if self.sizefunc is not None:
             size = self.sizefunc(s)
             if size < self.struct.size:
                 raise BadFormatError('struct size should be greater than %d bytes, got %d' % (self.struct.size, size))
             if len(buffer) < size:
                 return None
-            _set(s, '_extra', _copy(buffer[self.struct.size:size]))
+            _set(s, '_extra', _payload(buffer[self.struct.size:size]))
         else:
             _set(s, '_extra', b'')
             size = self.struct.size
-        return (s, size)
+        return size
+    def _clearstruct(self, namedstruct):
+        # Every field is unpacked again, only the sub-class parts need to be removed
+        if '_sub' in namedstruct.__dict__:
+            Parser._clearstruct(self, namedstruct)
     def _new(self, inlineparent = None):
         s = _create_struct(self, inlineparent)
-        s._unpack(self.emptydata)
+        _setprototype(s._target, self.prototype, s._target)
+        _set(s, '_extra', b'')
         return s
     def sizeof(self, namedstruct):
         '''
         Return the "real" size of the struct.
         '''
         return self.struct.size
+    @property
+    def staticsize(self):
+        if self._fixedlayout():
+            return self.paddingsize2(self.struct.size)
+        else:
+            return None
     def unpack(self, data, namedstruct):
         '''
         Unpack the struct from specified bytes. If the struct is sub-classed, definitions from the sub type
@@ -919,9 +1623,60 @@ class FormatParser(Parser):
             result = self.struct.unpack(data[0:self.struct.size])
         except struct.error as exc:
             raise BadFormatError(exc)
+        self._setproperties(result, namedstruct._target)
+        return data[self.struct.size:]
+    def unpackfrom(self, buffer, offset, target):
+        '''
+        Unpack the fields from buffer at offset directly into target (without creating a struct), used
+        when the fields are flattened into a sequenced parent.
+        
+        :returns: used bytes, or None if the buffer is not long enough
+        '''
+        size = self.struct.size
+        if len(buffer) < offset + size:
+            return None
+        try:
+            result = self.struct.unpack_from(buffer, offset)
+        except struct.error as exc:
+            raise BadFormatError(exc)
+        self._setproperties(result, target)
+        return size
+    def newinto(self, target):
+        '''
+        Initialize the fields of a flattened member in target, like new()
+        '''
+        _setprototype(target, self.prototype, target)
+        if self.initfunc is not None:
+            self.initfunc(self.embedded(target))
+    def prepackinto(self, target):
+        '''
+        Run prepack of a flattened member in target
+        '''
+        if self.prepackfunc is not None:
+            self.prepackfunc(self.embedded(target))
+    def embedded(self, target):
+        '''
+        Create an EmbeddedStruct of a flattened member. The fields are already stored in target.
+        '''
+        s = _create_struct(self, target)
+        _set(s, '_extra', b'')
+        return s
+    def _setproperties(self, result, t):
         start = 0
-        t = namedstruct._target
         for p in self.properties:
+            if len(p) > 2:
+                # Inlined bitfield: the fields are split from one integer
+                setin = t
+                for sp in p[0]:
+                    if not hasattr(setin, sp):
+                        setin2 = InlineStruct(t)
+                        setattr(setin, sp, setin2)
+                        setin = setin2
+                    else:
+                        setin = getattr(setin, sp)
+                _unpackbits(result[start], p[2], setin)
+                start += 1
+                continue
             if len(p) > 1:
                 if isinstance(result[start], bytes):
                     v = [r.rstrip(b'\x00') for r in result[start:start + p[1]]]
@@ -936,13 +1691,12 @@ class FormatParser(Parser):
             setin = t
             for sp in p[0][0:-1]:
                 if not hasattr(setin, sp):
-                    setin2 = InlineStruct(namedstruct._target)
+                    setin2 = InlineStruct(t)
                     setattr(setin, sp, setin2)
                     setin = setin2
                 else:
                     setin = getattr(setin, sp)
             setattr(setin, p[0][-1], v)
-        return data[self.struct.size:]
     def pack(self, namedstruct):
         '''
         Pack the struct and return the packed bytes.
@@ -951,14 +1705,23 @@ class FormatParser(Parser):
         
         :returns: packed bytes, only contains fields of definitions in this type, not the sub type and "extra" data.
         '''
+        return self.packfrom(namedstruct._target)
+    def packfrom(self, t):
+        '''
+        Pack the fields stored in target t
+        '''
         elements = []
-        t = namedstruct._target
         for p in self.properties:
             v = t
             for sp in p[0]:
                 v = getattr(v, sp)
-            if len(p) > 1:
+            if len(p) > 2:
+                elements.append(_packbits(v, p[2]))
+            elif len(p) > 1:
                 elements.extend(v[0:p[1]])
+                if len(v) < p[1]:
+                    # Short arrays are filled with empty values, same as arrays which are not inlined
+                    elements.extend(self.empty[len(elements):len(elements) + p[1] - len(v)])
             else:
                 elements.append(v)
         return self.struct.pack(*elements)
@@ -1002,6 +1765,10 @@ class SequencedParser(Parser):
         if lastextra:
             self.parserseq = parserseq[0:-1]
             self.extra = parserseq[-1]
+            if self.extra[1] is _FLATTEN:
+                self.extra = (self.extra[0], None)
+        # Parsers of the embedded structs in _seqs; named members do not have entries in _seqs
+        self.embeddedparsers = [p for p, name in self.parserseq if name is None or name is _FLATTEN]
 
     def _parse(self, buffer, inlineparent = None):
         s = _create_struct(self, inlineparent)
@@ -1011,17 +1778,35 @@ class SequencedParser(Parser):
         else:
             return (s, size)
 
+    def _parsestruct(self, buffer, namedstruct):
+        return self._parseinner(buffer, namedstruct, True, False)
+
     def _parseinner(self, buffer, namedstruct, copy = False, useall = True):
         s = namedstruct
         inlineparent = s._target
         s._seqs = []
         start = 0
         for p, name in self.parserseq:
+            if name is _FLATTEN:
+                if p.flat:
+                    size = p.unpackfrom(buffer, start, inlineparent)
+                    if size is None:
+                        return None
+                    s._seqs.append(None)
+                    start += size
+                    continue
+                name = None
             parent = None
             if name is None:
                 parent = inlineparent
             if name is not None and len(name) > 1:
                 # Array
+                if _bulkarray(p):
+                    if len(buffer) - start < p.staticsize * name[1]:
+                        return None
+                    setattr(inlineparent, name[0], p.unpackarray(buffer, start, name[1]))
+                    start += p.staticsize * name[1]
+                    continue
                 v = []
                 for _ in range(0, name[1]):
                     r = p.parse(buffer[start:], parent)
@@ -1047,11 +1832,15 @@ class SequencedParser(Parser):
                 size = self.sizefunc(s)
                 if size < start:
                     raise BadFormatError('struct size should be greater than %d bytes, got %d' % (start, size))
+                if len(buffer) < size:
+                    return None
             else:
                 size = start
         if hasattr(self, 'extra'):
             p, name = self.extra
-            if name is not None and len(name) > 1:
+            if name is not None and len(name) > 1 and _bulkarray(p):
+                setattr(inlineparent, name[0], p.unpackarray(buffer, start, (size - start) // p.staticsize))
+            elif name is not None and len(name) > 1:
                 extraArray = []
                 while start < size:
                     r = p.parse(buffer[start:size], None)
@@ -1067,7 +1856,7 @@ class SequencedParser(Parser):
                 else:
                     setattr(inlineparent, name[0], p.create(buffer[start:size], None))
         else:
-            _set(s, '_extra', _copy(buffer[start:size]))
+            _set(s, '_extra', _payload(buffer[start:size]))
         return size
 
     def unpack(self, data, namedstruct):
@@ -1087,9 +1876,23 @@ class SequencedParser(Parser):
         seqiter = iter(s._seqs)
         totalsize = 0
         for p, name in self.parserseq:
+            if name is _FLATTEN:
+                v = next(seqiter)
+                if v is None:
+                    data = p.packfrom(inlineparent)
+                    stream.write(data)
+                    totalsize += len(data)
+                else:
+                    totalsize += _tostream(p, v, stream, True)
+                continue
             if name is not None and len(name) > 1:
                 # Array
                 v = getattr(inlineparent, name[0])
+                if _bulkarray(p):
+                    data = p.packarray(_fillarray(p, v, name[1]))
+                    stream.write(data)
+                    totalsize += len(data)
+                    continue
                 for i in range(0, name[1]):
                     if i >= len(v):
                         tp = p.new()
@@ -1109,8 +1912,13 @@ class SequencedParser(Parser):
             p, name = self.extra
             if name is not None and len(name) > 1:
                 v = getattr(inlineparent, name[0])
-                for es in v:
-                    totalsize += _tostream(p, es, stream, True)
+                if _bulkarray(p):
+                    data = p.packarray(v)
+                    stream.write(data)
+                    totalsize += len(data)
+                else:
+                    for es in v:
+                        totalsize += _tostream(p, es, stream, True)
             else:
                 if name is None:
                     v = next(seqiter)
@@ -1120,6 +1928,62 @@ class SequencedParser(Parser):
                     totalsize += _tostream(p, v, stream, True)
         return totalsize
 
+    def packiter(self, namedstruct):
+        '''
+        Same as packto(), but generate the packed bytes piece by piece, for NamedStruct._iterbytes().
+        Elements of arrays are packed one by one.
+        '''
+        s = namedstruct
+        inlineparent = s._target
+        seqiter = iter(s._seqs)
+        for p, name in self.parserseq:
+            if name is _FLATTEN:
+                v = next(seqiter)
+                if v is None:
+                    yield p.packfrom(inlineparent)
+                else:
+                    for piece in _packpieces(p, v):
+                        yield piece
+            elif name is not None and len(name) > 1:
+                # Array
+                v = getattr(inlineparent, name[0])
+                if _bulkarray(p):
+                    yield p.packarray(_fillarray(p, v, name[1]))
+                    continue
+                for i in range(0, name[1]):
+                    if i >= len(v):
+                        tp = p.new()
+                        if hasattr(p, 'fullprepack'):
+                            p.fullprepack(tp)
+                    else:
+                        tp = v[i]
+                    for piece in _packpieces(p, tp):
+                        yield piece
+            else:
+                if name is not None:
+                    v = getattr(inlineparent, name[0])
+                else:
+                    v = next(seqiter)
+                for piece in _packpieces(p, v):
+                    yield piece
+        if hasattr(self, 'extra'):
+            p, name = self.extra
+            if name is not None and len(name) > 1:
+                v = getattr(inlineparent, name[0])
+                if _bulkarray(p):
+                    yield p.packarray(v)
+                else:
+                    for es in v:
+                        for piece in _packpieces(p, es):
+                            yield piece
+            else:
+                if name is None:
+                    v = next(seqiter)
+                else:
+                    v = getattr(inlineparent, name[0])
+                for piece in _packpieces(p, v):
+                    yield piece
+
     def pack(self, namedstruct):
         stream = BytesIO()
         self.packto(namedstruct, stream)
@@ -1130,6 +1994,12 @@ class SequencedParser(Parser):
         inlineparent = s._target
         s._seqs = []
         for p, name in self.parserseq:
+            if name is _FLATTEN:
+                if p.flat:
+                    p.newinto(inlineparent)
+                    s._seqs.append(None)
+                    continue
+                name = None
             if name is not None and len(name) > 1:
                 # Array
                 v = [p.new() for _ in range(0, name[1])]
@@ -1160,9 +2030,20 @@ class SequencedParser(Parser):
         inlineparent = s._target
         seqiter = iter(s._seqs)
         for p, name in self.parserseq:
+            if name is _FLATTEN:
+                v = next(seqiter)
+                if v is None:
+                    size += p.struct.size
+                else:
+                    size += p.paddingsize(v)
+                continue
             if name is not None and len(name) > 1:
                 # Array
+                elemsize = getattr(p, 'staticsize', None)
                 v = getattr(inlineparent, name[0])
+                if elemsize is not None and not _hasextra(p, v):
+                    size += elemsize * name[1]
+                    continue
                 for i in range(0, name[1]):
                     if i >= len(v):
                         tp = p.new()
@@ -1181,8 +2062,12 @@ class SequencedParser(Parser):
             p, name = self.extra
             if name is not None and len(name) > 1:
                 v = getattr(inlineparent, name[0])
-                for es in v:
-                    size += p.paddingsize(es)
+                elemsize = getattr(p, 'staticsize', None)
+                if elemsize is not None and not _hasextra(p, v):
+                    size += elemsize * len(v)
+                else:
+                    for es in v:
+                        size += p.paddingsize(es)
             else:
                 if name is None:
                     v = next(seqiter)
@@ -1190,13 +2075,33 @@ class SequencedParser(Parser):
                     v = getattr(inlineparent, name[0])
                 size += p.paddingsize(v)
         return size
+    @property
+    def staticsize(self):
+        if not self._fixedlayout() or hasattr(self, 'extra'):
+            return None
+        size = 0
+        for p, name in self.parserseq:
+            elemsize = getattr(p, 'staticsize', None)
+            if elemsize is None:
+                return None
+            if name is not None and name is not _FLATTEN and len(name) > 1:
+                size += elemsize * name[1]
+            else:
+                size += elemsize
+        return self.paddingsize2(size)
     def prepack(self, namedstruct, skip_self=False, skip_sub=False):
         if not skip_sub:
             s = namedstruct
             inlineparent = s._target
             seqiter = iter(s._seqs)
             for p, name in self.parserseq:
-                if hasattr(p, 'fullprepack'):
+                if name is _FLATTEN:
+                    v = next(seqiter)
+                    if v is None:
+                        p.prepackinto(inlineparent)
+                    else:
+                        p.fullprepack(v)
+                elif hasattr(p, 'fullprepack'):
                     if name is not None and len(name) > 1:
                         # Array
                         v = getattr(inlineparent, name[0])
@@ -1239,10 +2144,16 @@ class PrimitiveParser(object):
         :param endian: endian specifier, default to '>'
         '''
         self.struct = struct.Struct(endian + fmt)
+        self.staticsize = self.struct.size
         self.emptydata = b'\x00' * self.struct.size
         self.empty = self.struct.unpack(self.emptydata)[0]
         if isinstance(self.empty, bytes):
             self.empty = b''
+        # Arrays of single character formats are unpacked and packed with one struct call
+        if len(fmt) == 1 and fmt not in 'sp':
+            self.arrayformat = endian + '%d' + fmt
+        else:
+            self.arrayformat = None
     def parse(self, buffer, inlineparent = None):
         '''
         Compatible to Parser.parse()
@@ -1284,6 +2195,46 @@ class PrimitiveParser(object):
     def tostream(self, prim, stream, skipprepack = False):
         r = self.tobytes(prim, skipprepack=skipprepack)
         return stream.write(r)
+    def unpackarray(self, buffer, offset, count):
+        '''
+        Unpack *count* values from *buffer* at *offset* with one struct call. Only available
+        when arrayformat is not None. The buffer must be large enough.
+        
+        :returns: a list of values
+        '''
+        try:
+            return list(struct.unpack_from(self.arrayformat % (count,), buffer, offset))
+        except struct.error as exc:
+            raise BadFormatError(exc)
+    def packarray(self, values):
+        '''
+        Pack a sequence of values with one struct call. Only available when arrayformat is not None.
+        '''
+        return struct.pack(self.arrayformat % (len(values),), *values)
+
+
+def _bulkarray(parser):
+    # True if an array of this parser can be unpacked and packed with one struct call
+    return getattr(parser, 'arrayformat', None) is not None
+
+
+def _fillarray(parser, v, arraysize):
+    # Truncate or pad the array values to exactly arraysize elements
+    if len(v) == arraysize:
+        return v
+    v = list(v[:arraysize])
+    v.extend(parser.new() for _ in range(len(v), arraysize))
+    return v
+
+
+def _hasextra(parser, values):
+    # True if a struct in values has "extra" data, which is not included in the staticsize
+    if not isinstance(parser, Parser):
+        return False
+    for v in values:
+        if getattr(v, '_extra', None) or getattr(v, '_sub', None) is not None:
+            return True
+    return False
 
 
 class ArrayParser(object):
@@ -1300,10 +2251,16 @@ class ArrayParser(object):
         '''
         self.innerparser = innerparser
         self.size = size
+        self.bulk = _bulkarray(innerparser)
     def parse(self, buffer, inlineparent = None):
         '''
         Compatible to Parser.parse()
         '''
+        if self.bulk:
+            size = self.innerparser.staticsize * self.size
+            if len(buffer) < size:
+                return None
+            return (self.innerparser.unpackarray(buffer, 0, self.size), size)
         size = 0
         v = []
         for i in range(0, self.size):  # @UnusedVariable
@@ -1331,6 +2288,8 @@ class ArrayParser(object):
                 raise ParseError('data is not enough to create an array of size ' + self.size)
             else:
                 return r[0]
+        elif self.bulk:
+            return self.innerparser.unpackarray(data, 0, len(data) // self.innerparser.staticsize)
         else:
             v = []
             start = 0
@@ -1349,6 +2308,9 @@ class ArrayParser(object):
         arraysize = self.size
         if arraysize == 0:
             arraysize = len(prim)
+        elemsize = getattr(self.innerparser, 'staticsize', None)
+        if elemsize is not None and not _hasextra(self.innerparser, prim):
+            return elemsize * arraysize
         for i in range(0, arraysize):
             if i >= len(prim):
                 tp = self.innerparser.new()
@@ -1363,6 +2325,17 @@ class ArrayParser(object):
         Compatible to Parser.paddingsize()
         '''
         return self.sizeof(prim)
+    @property
+    def staticsize(self):
+        '''
+        Size of a fixed size array of fixed size elements, or None
+        '''
+        if self.size == 0:
+            return None
+        elemsize = getattr(self.innerparser, 'staticsize', None)
+        if elemsize is None:
+            return None
+        return elemsize * self.size
     def tobytes(self, prim, skipprepack = False):
         '''
         Compatible to Parser.tobytes()
@@ -1375,6 +2348,10 @@ class ArrayParser(object):
         totalsize = 0
         if arraysize == 0:
             arraysize = len(prim)
+        if self.bulk:
+            data = self.innerparser.packarray(_fillarray(self.innerparser, prim, arraysize))
+            stream.write(data)
+            return len(data)
         for i in range(0, arraysize):
             if i >= len(prim):
                 tp = self.innerparser.new()
@@ -1413,10 +2390,16 @@ class RawParser(object):
         '''
         Compatible to Parser.create()
         '''
-        if self.cstr:
-            return _copy(data).rstrip(b'\x00')
+        data = _payload(data)
+        if not self.cstr:
+            return data
+        elif isinstance(data, memoryview):
+            end = len(data)
+            while end > 0 and data[end - 1] in (0, b'\x00'):
+                end -= 1
+            return data[:end]
         else:
-            return _copy(data)
+            return data.rstrip(b'\x00')
     def sizeof(self, prim):
         '''
         Compatible to Parser.sizeof()
@@ -1431,7 +2414,7 @@ class RawParser(object):
         '''
         Compatible to Parser.tobytes()
         '''
-        return prim
+        return _asbytes(prim)
     def tostream(self, prim, stream, skipprepack = False):
         return stream.write(prim)
 
@@ -1447,7 +2430,7 @@ class CstrParser(object):
     def parse(self, buffer, inlineparent = None):
         for i in range(0, len(buffer)):
             if buffer[i] in (0, b'\x00'):
-                return (_copy(buffer[:i]), i + 1)
+                return (_payload(buffer[:i]), i + 1)
         return None
     def new(self, inlineparent = None):
         return b''
@@ -1457,18 +2440,346 @@ class CstrParser(object):
         for i in range(0, len(data) - 1):
             if data[i] in (0, b'\x00'):
                 raise BadFormatError('Cstr has zero inside the string')
-        return _copy(data)
+        return _payload(data)
     def sizeof(self, prim):
         return len(prim) + 1
     def paddingsize(self, prim):
         return self.sizeof(prim)
     def tobytes(self, prim, skipprepack = False):
-        return prim + b'\x00'
+        return _asbytes(prim) + b'\x00'
     def tostream(self, prim, stream, skipprepack = False):
         stream.write(prim)
         stream.write(b'\x00')
         return len(prim) + 1
 
+# Key of an element which is not parsed from bytes: it is computed when needed
+_NOKEY = object()
+
+
+def _readonlyerror(*args, **kwargs):
+    raise TypeError('An element of a lazyarray or tlvlist with cache = False is read-only, '
+                    'replace the element in the list instead')
+
+
+class _ReadOnlyList(list):
+    '''
+    A list field of a read-only element
+    '''
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = __iadd__ = __imul__ = _readonlyerror
+    append = extend = insert = pop = remove = reverse = sort = _readonlyerror
+
+
+class _ReadOnlyStruct(NamedStruct):
+    '''
+    An element parsed by a LazyList without cache. Modifying it raises TypeError, because the
+    modification would be lost: the list is packed from the original bytes. _clone() creates a
+    modifiable copy.
+    '''
+    _writableclass = NamedStruct
+    def __setattr__(self, name, value):
+        if name[:1] != '_':
+            _readonlyerror()
+        object.__setattr__(self, name, value)
+    def __delattr__(self, name):
+        if name[:1] != '_':
+            _readonlyerror()
+        object.__delattr__(self, name)
+    _setextra = _readonlyerror
+    _replace_embedded_type = _readonlyerror
+    def _prepack(self):
+        # Packed as it is parsed
+        pass
+    def _clone(self):
+        c = NamedStruct._clone(self)
+        object.__setattr__(c, '__class__', self._writableclass)
+        return c
+    def __setstate__(self, state):
+        object.__setattr__(self, '__class__', self._writableclass)
+        self.__setstate__(state)
+        _readonly(self)
+
+
+class _ReadOnlyValueStruct(ValueStruct):
+    '''
+    Read-only ValueStruct, see _ReadOnlyStruct
+    '''
+    _writableclass = ValueStruct
+    __setattr__ = _ReadOnlyStruct.__dict__['__setattr__']
+    __delattr__ = _ReadOnlyStruct.__dict__['__delattr__']
+    _setextra = _readonlyerror
+    _replace_embedded_type = _readonlyerror
+    _prepack = _ReadOnlyStruct.__dict__['_prepack']
+    _clone = _ReadOnlyStruct.__dict__['_clone']
+    __setstate__ = _ReadOnlyStruct.__dict__['__setstate__']
+
+
+class _ReadOnlyInlineStruct(InlineStruct):
+    '''
+    An inlined struct of a read-only element
+    '''
+    __setattr__ = _ReadOnlyStruct.__dict__['__setattr__']
+    __delattr__ = _ReadOnlyStruct.__dict__['__delattr__']
+
+
+_READONLY_CLASSES = {NamedStruct: _ReadOnlyStruct, ValueStruct: _ReadOnlyValueStruct,
+                     InlineStruct: _ReadOnlyInlineStruct}
+
+
+def _readonly(v):
+    '''
+    Make a parsed value read-only, for LazyList without cache
+    '''
+    if type(v) is list:
+        return _ReadOnlyList(_readonly(v2) for v2 in v)
+    cls = _READONLY_CLASSES.get(type(v))
+    if cls is not None:
+        d = v.__dict__
+        for k in list(d):
+            if k[:1] != '_':
+                d[k] = _readonly(d[k])
+        object.__setattr__(v, '__class__', cls)
+    return v
+
+
+class LazyList(MutableSequence):
+    '''
+    Parsed result of a *lazyarray* type. It is a mutable sequence of elements like a list, but the
+    elements are only parsed when they are accessed. The offset and the size of every element are
+    indexed when the list is created, without parsing the elements.
+    
+    Elements which are never accessed are packed again from the original bytes.
+    '''
+    def __init__(self, parser, buffer = b'', keys = (), offsets = (), sizes = ()):
+        self._parser = parser
+        self._buffer = buffer
+        self._keys = list(keys)
+        self._offsets = list(offsets)
+        self._sizes = list(sizes)
+        self._items = [None] * len(self._keys)
+    def _getitem(self, i):
+        item = self._items[i]
+        if item is None:
+            offset = self._offsets[i]
+            r = self._parser.innerparser.parse(memoryview(self._buffer)[offset:offset + self._sizes[i]])
+            if r is None:
+                raise BadLenError('element %d is not complete' % (i,))
+            item = r[0]
+            if self._parser.cache:
+                self._items[i] = item
+            else:
+                item = _readonly(item)
+        return item
+    def __len__(self):
+        return len(self._keys)
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._getitem(j) for j in range(*i.indices(len(self._keys)))]
+        if i < 0:
+            i += len(self._keys)
+        return self._getitem(i)
+    def __iter__(self):
+        for i in range(0, len(self._keys)):
+            yield self._getitem(i)
+    def _reset(self, items):
+        self._keys = [_NOKEY] * len(items)
+        self._offsets = [None] * len(items)
+        self._sizes = [None] * len(items)
+        self._items = items
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            items = list(self)
+            items[i] = value
+            self._reset(items)
+        else:
+            self._items[i] = value
+            self._keys[i] = _NOKEY
+            self._offsets[i] = None
+            self._sizes[i] = None
+    def __delitem__(self, i):
+        del self._keys[i]
+        del self._offsets[i]
+        del self._sizes[i]
+        del self._items[i]
+    def insert(self, i, value):
+        self._keys.insert(i, _NOKEY)
+        self._offsets.insert(i, None)
+        self._sizes.insert(i, None)
+        self._items.insert(i, value)
+    def __eq__(self, other):
+        if isinstance(other, (LazyList, list)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+    def __ne__(self, other):
+        r = self.__eq__(other)
+        if r is NotImplemented:
+            return r
+        return not r
+    __hash__ = None
+    def __repr__(self, *args, **kwargs):
+        return '%s(%r)' % (type(self).__name__, list(self),)
+    def _clone(self):
+        c = type(self)(self._parser, self._buffer)
+        c._keys = list(self._keys)
+        c._offsets = list(self._offsets)
+        c._sizes = list(self._sizes)
+        c._items = [None if item is None else _clonevalue(item, None) for item in self._items]
+        return c
+
+
+class TLVList(LazyList):
+    '''
+    Parsed result of a *tlvlist* type. It is a LazyList, and the type key of every element is also
+    indexed, to find elements by type without parsing the others.
+    '''
+    def _key(self, i):
+        key = self._keys[i]
+        if key is _NOKEY:
+            # Computed once for an element set to the list, until the element is replaced
+            key = self._parser.getkey(self._parser.innerparser.tobytes(self._items[i]))
+            self._keys[i] = key
+        return key
+    def get(self, key, default = None):
+        '''
+        Get the first element with the type key. Only this element is parsed.
+        
+        :param key: the type key, see *tlvlist*
+        
+        :param default: returned if there is no element with the type key
+        '''
+        for i in range(0, len(self._keys)):
+            if self._key(i) == key:
+                return self._getitem(i)
+        return default
+    def getall(self, key):
+        '''
+        Get all the elements with the type key. Only these elements are parsed.
+        
+        :returns: a list of elements
+        '''
+        return [self._getitem(i) for i in range(0, len(self._keys)) if self._key(i) == key]
+
+
+class LazyListParser(object):
+    '''
+    Parser for *lazyarray* and *tlvlist*. The whole data is used (like a variable length array).
+    '''
+    def __init__(self, innerparser, header = None, sizefunc = None, keyfunc = None, cache = True):
+        '''
+        :param innerparser: element parser
+        
+        :param header: struct.Struct object of the element header, or None if the elements are fixed size
+        
+        :param sizefunc: get the element size from the unpacked header tuple
+        
+        :param keyfunc: get the type key from the unpacked header tuple. If not None, the parsed result
+                        is a TLVList; else it is a LazyList.
+        
+        :param cache: if True, keep the parsed elements in the list
+        '''
+        self.innerparser = innerparser
+        self.header = header
+        self.keyfunc = keyfunc
+        self.sizefunc = sizefunc
+        self.cache = cache
+        if keyfunc is None:
+            self.listclass = LazyList
+        else:
+            self.listclass = TLVList
+    def getkey(self, data):
+        return self.keyfunc(self.header.unpack_from(data, 0))
+    def _lazylist(self, prim):
+        # A list may also be assigned to the field
+        if isinstance(prim, LazyList):
+            return prim
+        v = self.listclass(self)
+        v._reset(list(prim))
+        return v
+    def parse(self, buffer, inlineparent = None):
+        '''
+        Compatible to Parser.parse()
+        '''
+        return (self.listclass(self), 0)
+    def new(self, inlineparent = None):
+        '''
+        Compatible to Parser.new()
+        '''
+        return self.listclass(self)
+    def create(self, data, inlineparent = None):
+        '''
+        Compatible to Parser.create()
+        '''
+        data = _payload(data)
+        header = self.header
+        if header is None:
+            # Fixed size elements
+            elemsize = self.innerparser.staticsize
+            count = len(data) // elemsize
+            return self.listclass(self, data, [None] * count, range(0, count * elemsize, elemsize), [elemsize] * count)
+        headersize = header.size
+        keyfunc = self.keyfunc
+        keys = []
+        offsets = []
+        sizes = []
+        start = 0
+        end = len(data)
+        while end - start >= headersize:
+            h = header.unpack_from(data, start)
+            size = self.sizefunc(h)
+            if size < headersize:
+                raise BadLenError('element size should be at least %d bytes, got %d' % (headersize, size))
+            if start + size > end:
+                break
+            keys.append(None if keyfunc is None else keyfunc(h))
+            offsets.append(start)
+            sizes.append(size)
+            start += size
+        return self.listclass(self, data, keys, offsets, sizes)
+    def sizeof(self, prim):
+        '''
+        Compatible to Parser.sizeof()
+        '''
+        prim = self._lazylist(prim)
+        size = 0
+        for i in range(0, len(prim._items)):
+            item = prim._items[i]
+            if item is None:
+                size += prim._sizes[i]
+            else:
+                size += self.innerparser.paddingsize(item)
+        return size
+    def paddingsize(self, prim):
+        '''
+        Compatible to Parser.paddingsize()
+        '''
+        return self.sizeof(prim)
+    def tobytes(self, prim, skipprepack = False):
+        '''
+        Compatible to Parser.tobytes()
+        '''
+        stream = BytesIO()
+        self.tostream(prim, stream, skipprepack)
+        return stream.getvalue()
+    def tostream(self, prim, stream, skipprepack = False):
+        prim = self._lazylist(prim)
+        totalsize = 0
+        view = None
+        for i in range(0, len(prim._items)):
+            item = prim._items[i]
+            if item is None:
+                if view is None:
+                    view = memoryview(prim._buffer)
+                offset = prim._offsets[i]
+                totalsize += stream.write(view[offset:offset + prim._sizes[i]])
+            else:
+                totalsize += _tostream(self.innerparser, item, stream, skipprepack)
+        return totalsize
+    def fullprepack(self, value):
+        if hasattr(self.innerparser, 'fullprepack'):
+            for item in self._lazylist(value)._items:
+                if item is not None:
+                    self.innerparser.fullprepack(item)
+
+
 class typedef(object):
     '''
     Base class for type definitions. Types defined with *nstruct*, *prim*, *optional*, *bitfield*
@@ -1479,7 +2790,12 @@ class typedef(object):
         Get parser for this type. Create the parser on first call.
         '''
         if not hasattr(self, '_parser'):
-            self._parser = self._compile()
+            with _compile_lock:
+                if not hasattr(self, '_parser'):
+                    p = self._compile()
+                    if isinstance(p, Parser) and p.typedef is self:
+                        p._register()
+                    self._parser = p
         return self._parser
     def parse(self, buffer):
         '''
@@ -1492,6 +2808,77 @@ class typedef(object):
                   the used bytes length, so the next struct begins from buffer[size:]
         '''
         return self.parser().parse(buffer)
+    def parse_into(self, obj, buffer):
+        '''
+        Parse the type from specified bytes stream into an existing struct, reusing the struct object
+        instead of creating a new one. All the fields (and sub-class parts) of the struct are replaced.
+        
+        :param obj: a struct created (or parsed) with this type or its base type, or None to take a struct
+                    from the free list (see set_freelist()), or create a new one if the free list is empty.
+        
+        :param buffer: bytes from a stream, same as parse()
+        
+        :returns: None if the data is incomplete (the content of obj is undefined); (obj, size) else. obj
+                  may be sub-classed to another type.
+        '''
+        p = self.parser()
+        if not isinstance(p, Parser):
+            raise TypeError('%r is not a struct type' % (self,))
+        return p.parseinto(obj, buffer)
+    def set_freelist(self, size):
+        '''
+        Enable a free list for parse_into(). Structs returned with release() are reused by parse_into()
+        instead of creating new structs. The free list is shared by the type and its sub-class types.
+        
+        :param size: max number of structs in the free list. 0 disables the free list.
+        '''
+        p = self.parser()
+        if not isinstance(p, Parser):
+            raise TypeError('%r is not a struct type' % (self,))
+        while p.base is not None:
+            p = p.base
+        p.freelistsize = size
+        p.freelist = [] if size > 0 else None
+    def set_compare(self, mode = COMPARE_BYTES):
+        '''
+        Compare and hash the structs of this type (and its base types and sub-class types) by value, so
+        they can be used as dictionary keys or in sets. Only the structs created after this call are
+        affected.
+        
+        :param mode: COMPARE_BYTES to compare the type and the packed bytes (prepack is executed on a copy);
+                     COMPARE_FIELDS to compare the sub-class type and the field values (including "extra"
+                     data); None to compare by identity (the default).
+        '''
+        if mode is not None and mode != COMPARE_BYTES and mode != COMPARE_FIELDS:
+            raise ValueError('Unknown compare mode %r' % (mode,))
+        p = self.parser()
+        if not isinstance(p, Parser):
+            raise TypeError('%r is not a struct type' % (self,))
+        while p.base is not None:
+            p = p.base
+        p.comparemode = mode
+        p.structclass = NamedStruct if mode is None else ValueStruct
+    def release(self, obj):
+        '''
+        Return a struct to the free list of the type. The struct must not be used after released. It is
+        dropped if the free list is disabled or full.
+        
+        :param obj: a struct created (or parsed) with this type or its base type
+        '''
+        p = self.parser()
+        if not isinstance(p, Parser):
+            raise TypeError('%r is not a struct type' % (self,))
+        p.release(obj)
+    def static_size(self):
+        '''
+        Get the size of this type if every value of this type has the same size (e.g. structs with only
+        fixed size fields, fixed size arrays of them, and bitfields). Arrays of these types compute
+        their sizes without visiting every element.
+        
+        :returns: the padded size in bytes, or None if the size depends on the value. "Extra" data of
+                  a value (e.g. from create() with more bytes than needed) is not counted.
+        '''
+        return getattr(self.parser(), 'staticsize', None)
     def create(self, buffer):
         '''
         Create a object from all the bytes. If there are additional bytes, they may be fed greedily to
@@ -1683,22 +3070,24 @@ class prim(typedef):
         :param endian: specify endian with struct format, default to '>' ("big endian" or "network order")
                        use '<' for little endian; do not use ''.
         
-        :param strict: disallow this type to be inlined. Only use strict = True if you want to
-                       use this type in structs with different endian (e.g. little endian integer in a big endian struct)
+        :param strict: always use the endian of this type, even if it is used in structs with different
+                       endian (e.g. little endian integer in a big endian struct). By default, an inlined
+                       primitive type uses the endian of the struct.
         '''
         typedef.__init__(self)
         self._format = fmt
-        self._inline = (fmt, ())
+        if strict:
+            # Fields of different endians are unpacked in groups, see _mkstruct
+            self._inline = (_endianformat(endian, fmt), ())
+        else:
+            self._inline = (fmt, ())
         self._readablename = readablename
         self._endian = endian
         self._strict = strict
     def _compile(self):
         return PrimitiveParser(self._format, self._endian)
     def inline(self):
-        if self._strict:
-            return None
-        else:
-            return self._inline
+        return self._inline
     def __repr__(self, *args, **kwargs):
         if self._readablename is not None:
             return str(self._readablename)
@@ -1802,7 +3191,7 @@ class fixedstruct(typedef):
         if nstructtype is None:
             nstructtype = self
         self.nstructtype = nstructtype
-        size = struct.calcsize(endian + self.format)
+        size = _mkstruct(endian, self.format).size
         paddingsize = (size + padding - 1) // padding * padding
         if paddingsize > size:
             paddingformat = self.format + str(paddingsize - size) + 'x'
@@ -1830,11 +3219,62 @@ class fixedstruct(typedef):
     def _reorder_properties(self, unordered_dict, ordered_dict, val):
         for p in self.properties:
             property_path = p[0]
-            _merge_to(property_path, unordered_dict, ordered_dict)
+            if len(p) > 2:
+                for name, _, _, _ in p[2]:
+                    _merge_to(property_path + (name,), unordered_dict, ordered_dict)
+            else:
+                _merge_to(property_path, unordered_dict, ordered_dict)
 
 class StructDefWarning(Warning):
     pass
 
+def _criteriaindex(subclasses):
+    '''
+    If the criteria of all the sub-class types are equality tests of the same field (see Expr._equality()),
+    create an index to find the sub-class type with one dictionary lookup.
+
+    :returns: (getter, {value: subtype}), or None
+    '''
+    path = None
+    index = {}
+    for t in subclasses:
+        expr = getattr(t, 'criteriaexpr', None)
+        if expr is None:
+            return None
+        r = expr._equality()
+        if r is None or (path is not None and r[0] != path):
+            return None
+        path = r[0]
+        for v in r[1]:
+            # The first matched sub-class type is used, same as testing the criteria in order
+            index.setdefault(v, t)
+    if path is None:
+        return None
+    return (_field(path)._func, index)
+
+
+def _derive(basetype, newchild):
+    '''
+    Register a new sub-class type and its classify values in the base type. The sub-class parser is
+    compiled later, when it is first selected.
+    '''
+    with _compile_lock:
+        basetype.subclasses = basetype.subclasses + [newchild]
+        p = getattr(basetype, '_parser', None)
+        if p is not None:
+            # A struct which may be sub-classed is not flattened from now on
+            p.flat = False
+        basetype.criteriaindex = _criteriaindex(basetype.subclasses)
+        classifyby = getattr(newchild, 'classifyby', None)
+        if classifyby is not None:
+            subindices = dict(basetype.subindices)
+            for v in classifyby:
+                subindices[v] = newchild
+            basetype.subindices = subindices
+            if p is not None and any(v in p.subindices for v in classifyby):
+                # An already compiled sub-class with the same value is replaced by the new type
+                p.subindices = dict((k, v) for k, v in p.subindices.items() if k not in classifyby)
+
 class nstruct(typedef):
     '''
     Generic purpose struct definition. Struct is defined by fields and options, for example::
@@ -2128,7 +3568,9 @@ class nstruct(typedef):
         :param arguments: optional keyword arguments, see nstruct docstring for more details:
         
                 size
-                    A function to retrieve the struct size
+                    A function to retrieve the struct size, or an expression like F.length (see
+                    namedstruct.expr). If *prepack* is not specified, an expression of one field
+                    is inverted to store the real size to the field, like packrealsize().
                     
                 prepack
                     A function to be executed just before packing, usually used to automatically store
@@ -2140,7 +3582,9 @@ class nstruct(typedef):
                     
                 criteria
                     A function determines whether this struct (of base type) should be sub-classed into
-                    this type
+                    this type, or an expression like F.type == 1. If the criteria of all the sub-class
+                    types are equality (or in_()) tests of the same field, the sub-class type is found
+                    with a dictionary lookup.
                     
                 endian
                     Default to '>' as big endian or "network order". Specify '<' to use little endian.
@@ -2184,8 +3628,15 @@ class nstruct(typedef):
                     e.g. extend a uint16 into an enumerate type to show the enumerate name; extend
                     a 6-bytes string to mac_addr_bytes to format the raw data to MAC address format, etc.
                     
+                flatten
+                    Default to True. Anonymous members of fixed size struct types, which are not
+                    sub-classed and not resized, are parsed and packed as part of this struct, without
+                    creating an embedded struct object. The embedded struct is created when it is
+                    really needed, e.g. by _get_embedded(). Specify False to always create embedded
+                    struct objects.
+                    
         '''
-        params = ['size', 'prepack', 'base', 'criteria', 'endian', 'padding', 'lastextra', 'name', 'inline', 'init', 'classifier', 'classifyby', 'formatter', 'extend']
+        params = ['size', 'prepack', 'base', 'criteria', 'endian', 'padding', 'lastextra', 'name', 'inline', 'init', 'classifier', 'classifyby', 'formatter', 'extend', 'flatten']
         for k in arguments:
             if not k in params:
                 warnings.warn(StructDefWarning('Parameter %r is not recognized, is there a spelling error?' % (k,)))
@@ -2195,6 +3646,14 @@ class nstruct(typedef):
         self.prepackfunc = arguments.get('prepack', None)
         self.base = arguments.get('base', None)
         self.criteria = arguments.get('criteria', _never)
+        if isinstance(self.sizefunc, Expr):
+            self.sizeexpr = self.sizefunc
+            self.sizefunc = self.sizeexpr._func
+            if 'prepack' not in arguments:
+                self.prepackfunc = _sizeprepack(self.sizeexpr)
+        if isinstance(self.criteria, Expr):
+            self.criteriaexpr = self.criteria
+            self.criteria = self.criteriaexpr._func
         self.endian = arguments.get('endian', '>')
         self.padding = arguments.get('padding', 8)
         self.lastextra = arguments.get('lastextra', None)
@@ -2202,7 +3661,10 @@ class nstruct(typedef):
         self.inlineself = arguments.get('inline', None)
         self.initfunc = arguments.get('init', None)
         self.classifier = arguments.get('classifier', None)
+        if isinstance(self.classifier, Expr):
+            self.classifier = self.classifier._func
         self.classifyby = arguments.get('classifyby', None)
+        self.flatten = arguments.get('flatten', True)
         if 'formatter' in arguments:
             self.extraformatter = arguments['formatter']
         self.formatters = {}
@@ -2228,6 +3690,7 @@ class nstruct(typedef):
             if 'padding' not in arguments:
                 warnings.warn(StructDefWarning('padding is not defined in %r; default to 8 (is that what you want?)' % (self,)))
         self.subclasses = []
+        self.subindices = {}
         lastinline_format = []
         lastinline_properties = []
         seqs = []
@@ -2278,39 +3741,37 @@ class nstruct(typedef):
                             lastinline_format.append(inline[0])
                             lastinline_properties.append(((m[1],),))
                         else:
-                            lastinline_format.append(str(struct.calcsize(endian + inline[0])) + 'x')
+                            lastinline_format.append(str(_mkstruct(endian, inline[0]).size) + 'x')
                     else:
                         if len(m) > 1:
                             lastinline_format.extend([inline[0]] * array)
                             lastinline_properties.append(((m[1],),array))
                         else:
-                            lastinline_format.append(str(struct.calcsize(endian + inline[0]) * array) + 'x')
+                            lastinline_format.append(str(_mkstruct(endian, inline[0]).size * array) + 'x')
                 else:
                     lastinline_format.append(inline[0])
                     for prop in inline[1]:
                         if len(m) > 1:
-                            if len(prop) > 1:
-                                lastinline_properties.append(((m[1],) + prop[0], prop[1]))
-                            else:
-                                lastinline_properties.append(((m[1],) + prop[0],))
+                            lastinline_properties.append(((m[1],) + prop[0],) + prop[1:])
                         else:
                             lastinline_properties.append(prop)
                     if len(m) > 1:
+                        # bitfield formatters use field names instead of property paths
                         if hasattr(t, 'formatters'):
                             for k,v in t.formatters.items():
-                                self.formatters[(m[1],) + k] = v
+                                self.formatters[(m[1],) + (k if isinstance(k, tuple) else (k,))] = v
                         if hasattr(t, 'listformatters'):
                             for k,v in t.listformatters.items():
-                                self.listformatters[(m[1],) + k] = v
+                                self.listformatters[(m[1],) + (k if isinstance(k, tuple) else (k,))] = v
                         if hasattr(t, 'extraformatter'):
                             self.formatters[(m[1],)] = v
                     else:
                         if hasattr(t, 'formatters'):
                             for k,v in t.formatters.items():
-                                self.formatters[k] = v
+                                self.formatters[k if isinstance(k, tuple) else (k,)] = v
                         if hasattr(t, 'listformatters'):
                             for k,v in t.listformatters.items():
-                                self.listformatters[k] = v
+                                self.listformatters[k if isinstance(k, tuple) else (k,)] = v
                         if hasattr(t, 'extraformatter'):
                             self.formatters[(t,)] = v                        
             else:
@@ -2382,15 +3843,15 @@ class nstruct(typedef):
             for t,name in self.seqs:
                 t.parser()
         if hasattr(self, '_parser'):
+            # Compiled and published by a nested parser() call while compiling the base or the members
             return self._parser
         if hasattr(self, 'fixedstruct'):
             p = self.fixedstruct.parser()
         else:
-            p = SequencedParser([(t.parser(), name) for t,name in self.seqs], self.sizefunc, self.prepackfunc, self.lastextra,
+            p = SequencedParser([(t.parser(), _FLATTEN if name is None and self.flatten and isinstance(t.parser(), FormatParser) else name)
+                                 for t,name in self.seqs],
+                                self.sizefunc, self.prepackfunc, self.lastextra,
                                 None if self.base is None else self.base.parser(), self.criteria, self.padding, self.initfunc, self, self.classifier, self.classifyby)
-        self._parser = p
-        for sc in self.subclasses:
-            sc.parser()
         return p
     def inline(self):
         return self._inline
@@ -2402,9 +3863,7 @@ class nstruct(typedef):
     def isextra(self):
         return (not self.sizefunc) and (not self.base) and self.lastextra
     def derive(self, newchild):
-        self.subclasses.append(newchild)
-        if hasattr(self, '_parser'):
-            newchild.parser()
+        _derive(self, newchild)
     def formatdump(self, dumpvalue, v):
         return nstruct._formatdump(self, dumpvalue, v)
     @staticmethod
@@ -2422,7 +3881,7 @@ class nstruct(typedef):
                     for i in range(0, len(current)):
                         current[i] = v(current[i])
                 except:
-                    NamedStruct._logger.log(logging.DEBUG, 'A formatter thrown an exception', exc_info = True)
+                    _formattererror()
             for k,v in ns.formatters.items():
                 current = dumpvalue
                 last = None
@@ -2439,22 +3898,23 @@ class nstruct(typedef):
                     try:
                         dumpvalue = v(dumpvalue)
                     except: 
-                        NamedStruct._logger.log(logging.DEBUG, 'A formatter thrown an exception', exc_info = True)
+                        _formattererror()
                 else:
                     try:
                         last[lastkey] = v(current)
                     except:
-                        NamedStruct._logger.log(logging.DEBUG, 'A formatter thrown an exception', exc_info = True)
+                        _formattererror()
             v2 = val
             while v2:
                 if hasattr(v2, '_seqs'):
-                    for s in v2._seqs:
+                    for i in range(0, len(v2._seqs)):
+                        s = _embeddedstruct(v2, i)
                         st = s._gettype()
                         if st is not None and hasattr(st, 'formatdump'):
                             dumpvalue = st.formatdump(dumpvalue, s)
                 v2 = getattr(v2, '_sub', None)
         except:
-            NamedStruct._logger.log(logging.DEBUG, 'A formatter thrown an exception', exc_info = True)
+            _formattererror()
         return dumpvalue
     def _reorder_properties(self, unordered_dict, ordered_dict, val):
         _basetype = val._getbasetype()
@@ -2469,9 +3929,10 @@ class nstruct(typedef):
             _seqindex = 0
             for s, name in self.seqs:
                 if name is None:
-                    t = val._seqs[_seqindex]._gettype()
+                    es = _embeddedstruct(val, _seqindex)
+                    t = es._gettype()
                     if hasattr(t, '_reorder_properties'):
-                        t._reorder_properties(unordered_dict, ordered_dict, val._seqs[_seqindex])
+                        t._reorder_properties(unordered_dict, ordered_dict, es)
                     _seqindex += 1
                 else:
                     _merge_to((name[0],), unordered_dict, ordered_dict)
@@ -2824,7 +4285,7 @@ class optional(typedef):
         :param prepackfunc: function to execute before pack, like in nstruct
         '''
         self.basetype = basetype
-        self.criteria = criteria
+        self.criteria = criteria._func if isinstance(criteria, Expr) else criteria
         self.prepackfunc = prepackfunc
         if name is None:
             raise ParseError('Optional member cannot be in-line member')
@@ -2855,19 +4316,20 @@ class optional(typedef):
                         try:
                             v[i] = self._listformatter(v[i])
                         except:
-                            NamedStruct._logger.log(logging.DEBUG, 'A formatter thrown an exception', exc_info = True)
+                            _formattererror()
                 if self._formatter:
                     dumpvalue[self.name] = self._formatter(v)                            
             v2 = val
             while v2:
                 if hasattr(v2, '_seqs'):
-                    for s in v2._seqs:
+                    for i in range(0, len(v2._seqs)):
+                        s = _embeddedstruct(v2, i)
                         st = s._gettype()
                         if st is not None and hasattr(st, 'formatdump'):
                             dumpvalue = st.formatdump(dumpvalue, s)
                 v2 = getattr(v2, '_sub', None)
         except:
-            NamedStruct._logger.log(logging.DEBUG, 'A formatter thrown an exception', exc_info = True)            
+            _formattererror()
         return dumpvalue
     def _reorder_properties(self, unordered_dict, ordered_dict, val):
         _merge_to((self.name,), unordered_dict, ordered_dict)
@@ -2922,8 +4384,17 @@ class DArrayParser(Parser):
             totalsize += _tostream(self.innertypeparser, item, stream)
         return totalsize
 
+    def packiter(self, namedstruct):
+        for item in getattr(namedstruct, self.name):
+            for piece in _packpieces(self.innertypeparser, item):
+                yield piece
+
     def sizeof(self, namedstruct):
-        return sum(self.innertypeparser.paddingsize(i) for i in getattr(namedstruct, self.name))
+        v = getattr(namedstruct, self.name)
+        elemsize = getattr(self.innertypeparser, 'staticsize', None)
+        if elemsize is not None and not _hasextra(self.innertypeparser, v):
+            return elemsize * len(v)
+        return sum(self.innertypeparser.paddingsize(i) for i in v)
     
     def prepack(self, namedstruct, skip_self=False, skip_sub=False):
         '''
@@ -2935,6 +4406,113 @@ class DArrayParser(Parser):
         Parser.prepack(self, namedstruct, skip_self, skip_sub)    
 
 
+class tlvlist(typedef):
+    '''
+    A list of type-length-value elements, which uses all the remaining bytes like a variable length array
+    (sometype[0]), but the elements are parsed lazily::
+    
+        oxmlist = tlvlist(ofp_oxm, 'I', lambda h: h[0], lambda h: (h[0] & 0xff) + 4)
+        ofp_match_oxm = nstruct((oxmlist, 'oxm_fields'), ...)
+        
+        m = ofp_match_oxm.create(data)
+        src = m.oxm_fields.get(OXM_OF_IPV4_SRC)
+    
+    On parsing, only the header of each element is unpacked to get the type key and the element
+    size; an element is parsed when it is accessed. The parsed result is a TLVList object, which is a
+    mutable sequence like a list, with additional methods *get(key)* and *getall(key)* to find elements
+    by type key. Elements which are not accessed are packed from the original bytes directly.
+    
+    The type key of a parsed element is not updated if the element is modified in place; replace
+    the element in the list instead.
+    '''
+    def __init__(self, innertype, header, key, size, endian = '>', cache = True):
+        '''
+        Initializer.
+        
+        :param innertype: type of the elements, usually a base type which is sub-classed by the type field
+        
+        :param header: struct format string (without endian) of the beginning of every element,
+                       which contains the type field and the length field. e.g. 'HH'
+        
+        :param key: a function to get the type key from the unpacked header (a tuple)
+        
+        :param size: a function to get the element size (including padding) from the unpacked header
+        
+        :param endian: endian of the header
+        
+        :param cache: same as *lazyarray*
+        '''
+        typedef.__init__(self)
+        self.innertype = innertype
+        self.header = header
+        self.key = key
+        self.size = size
+        self.endian = endian
+        self.cache = cache
+    def _compile(self):
+        return LazyListParser(self.innertype.parser(), struct.Struct(self.endian + self.header), self.size, self.key, self.cache)
+    def array(self, size):
+        raise TypeError('tlvlist cannot form array')
+    def isextra(self):
+        return True
+    def __repr__(self, *args, **kwargs):
+        return 'tlvlist(%r)' % (self.innertype,)
+
+
+class lazyarray(typedef):
+    '''
+    A variable length array (like sometype[0]) which parses the elements lazily::
+    
+        ofp_flow_stats_reply = nstruct((lazyarray(ofp_flow_stats, 'H', lambda h: h[0]), 'stats'), ...)
+        
+        r = ofp_flow_stats_reply.create(data)
+        page = r.stats[1000:1050]
+    
+    On parsing, the offset of every element is indexed with only the element header (or from the
+    element size, if the elements are fixed size); an element is parsed when it is accessed. The
+    parsed result is a LazyList object, which is a mutable sequence like a list, supporting len(),
+    indexing and slicing. Elements which are not accessed are packed from the original bytes directly.
+    '''
+    def __init__(self, innertype, header = None, size = None, endian = '>', cache = True):
+        '''
+        Initializer.
+        
+        :param innertype: type of the elements
+        
+        :param header: struct format string (without endian) of the beginning of every element, which
+                       contains the length field. e.g. 'H'. Not needed if the elements are fixed size.
+        
+        :param size: a function to get the element size (including padding) from the unpacked header
+        
+        :param endian: endian of the header
+        
+        :param cache: if True (default), a parsed element is kept in the list, so it can be modified
+                      in place. If False, an element is parsed again on every access, so a large list
+                      which is read once does not hold the parsed elements. The elements are read-only
+                      (modifying them raises TypeError), replace an element in the list instead; use
+                      _clone() to get a modifiable copy.
+        '''
+        typedef.__init__(self)
+        self.innertype = innertype
+        self.header = header
+        self.size = size
+        self.endian = endian
+        self.cache = cache
+    def _compile(self):
+        innerparser = self.innertype.parser()
+        if self.header is None:
+            if getattr(innerparser, 'staticsize', None) is None:
+                raise TypeError('%r is not fixed size, specify header and size for lazyarray' % (self.innertype,))
+            return LazyListParser(innerparser, cache = self.cache)
+        return LazyListParser(innerparser, struct.Struct(self.endian + self.header), self.size, None, self.cache)
+    def array(self, size):
+        raise TypeError('lazyarray cannot form array')
+    def isextra(self):
+        return True
+    def __repr__(self, *args, **kwargs):
+        return 'lazyarray(%r)' % (self.innertype,)
+
+
 class darray(typedef):
     '''
     Create a dynamic array field in a struct. The length of the array is calculated by other fields of
@@ -3004,20 +4582,67 @@ class darray(typedef):
                     try:
                         v[i] = listformatter(v[i])
                     except:
-                        NamedStruct._logger.log(logging.DEBUG, 'A formatter thrown an exception', exc_info = True)            
+                        _formattererror()
             v2 = val
             while v2:
                 if hasattr(v2, '_seqs'):
-                    for s in v2._seqs:
+                    for i in range(0, len(v2._seqs)):
+                        s = _embeddedstruct(v2, i)
                         st = s._gettype()
                         if st is not None and hasattr(st, 'formatdump'):
                             dumpvalue = st.formatdump(dumpvalue, s)
                 v2 = getattr(v2, '_sub', None)
         except:
-            NamedStruct._logger.log(logging.DEBUG, 'A formatter thrown an exception', exc_info = True)            
+            _formattererror()
         return dumpvalue
 
 
+def _bitspec(fields, totalbits):
+    '''
+    Pre-compute the shifts and masks of bit-fields.
+
+    :param fields: field definitions of a *bitfield*, ((start, end[, width]), name)
+
+    :param totalbits: bit size of the integer
+
+    :returns: a tuple of (name, shift, mask, shifts), *shifts* is a tuple of the shifts of every
+              element for a bit-field array, or None for a single field.
+    '''
+    spec = []
+    for f,n in fields:
+        if len(f) > 2:
+            width = f[2]
+            spec.append((n, 0, (1<<width) - 1, tuple(totalbits - b - width for b in range(f[0], f[1], width))))
+        else:
+            spec.append((n, totalbits - f[1], (1<<(f[1] - f[0])) - 1, None))
+    return tuple(spec)
+
+
+def _unpackbits(inner, spec, t):
+    '''
+    Split the integer *inner* into bit-fields and set them to t
+    '''
+    for n, shift, mask, shifts in spec:
+        if shifts is None:
+            setattr(t, n, (inner >> shift) & mask)
+        else:
+            setattr(t, n, [(inner >> b) & mask for b in shifts])
+
+
+def _packbits(t, spec):
+    '''
+    Merge the bit-fields stored in t to an integer
+    '''
+    data = 0
+    for n, shift, mask, shifts in spec:
+        if shifts is None:
+            data |= (getattr(t, n) & mask) << shift
+        else:
+            for v,b in zip(getattr(t, n), shifts):
+                data |= (v & mask) << b
+    return data
+
+
 class BitfieldParser(Parser):
     '''
     Parser for *bitfield*
@@ -3026,6 +4651,12 @@ class BitfieldParser(Parser):
         Parser.__init__(self, padding = 1, initfunc = init, typedef=typedef, prepackfunc=prepackfunc)
         self.basetypeparser = basetypeparser
         self.fields = fields
+        self.basesize = basetypeparser.sizeof(0)
+        self.spec = _bitspec(fields, self.basesize * 8)
+        # Field values of an empty struct, copied by new()
+        proto = InlineStruct(None)
+        _unpackbits(basetypeparser.new(), self.spec, proto)
+        self.prototype = _prototype(proto)
     def _parseinner(self, data, s, create = False):
         if create:
             inner = self.basetypeparser.create(data, None)
@@ -3035,15 +4666,7 @@ class BitfieldParser(Parser):
             if r is None:
                 return None
             (inner, size) = r
-        totalbits = size * 8
-        for f,n in self.fields:
-            if len(f) > 2:
-                width = f[2]
-                mask = (1<<width) - 1
-                setattr(s._target, n, [((inner >> (totalbits - b - width)) & mask) for b in range(f[0], f[1], width)])
-            else:
-                mask = (1<<(f[1] - f[0])) - 1
-                setattr(s._target, n, (inner >> (totalbits - f[1])) & mask)
+        _unpackbits(inner, self.spec, s._target)
         return size
     def _parse(self, data, inlineparent = None):
         s = _create_struct(self, inlineparent)
@@ -3054,7 +4677,8 @@ class BitfieldParser(Parser):
             return (s, size)
     def _new(self, inlineparent=None):
         s = _create_struct(self, inlineparent)
-        s._unpack(self.basetypeparser.tobytes(self.basetypeparser.new()))
+        _setprototype(s._target, self.prototype, s._target)
+        _set(s, '_extra', b'')
         return s
     def unpack(self, data, namedstruct):
         size = self._parseinner(data, namedstruct, True)
@@ -3063,20 +4687,15 @@ class BitfieldParser(Parser):
         else:
             return data[size:]
     def pack(self, namedstruct):
-        data = 0
-        totalbits = self.basetypeparser.sizeof(0) * 8
-        for f,n in self.fields:
-            if len(f) > 2:
-                width = f[2]
-                mask = (1<<width) - 1
-                for v,b in zip(getattr(namedstruct, n), range(f[0], f[1], width)):
-                    data |= ((v & mask) << (totalbits - b - width))
-            else:
-                mask = (1<<(f[1] - f[0])) - 1
-                data |= ((getattr(namedstruct, n) & mask) << (totalbits - f[1]))
-        return self.basetypeparser.tobytes(data)
+        return self.basetypeparser.tobytes(_packbits(namedstruct, self.spec))
     def sizeof(self, namedstruct):
-        return self.basetypeparser.sizeof(0)
+        return self.basesize
+    @property
+    def staticsize(self):
+        if self._fixedlayout():
+            return self.basesize
+        else:
+            return None
 
 class bitfield(typedef):
     '''
@@ -3123,8 +4742,16 @@ class bitfield(typedef):
                         
                         prepack
                             similar to *prepack* option in nstruct
-        '''
-        params = ['name', 'init', 'extend', 'formatter', 'prepack']
+                        
+                        inline
+                            if True, the bitfield is inlined into the parent struct: it is unpacked
+                            together with the other fields of the parent struct, and the fields are
+                            split with pre-computed shifts and masks. A named member of an inlined
+                            bitfield type is not a separated struct (it does not have _gettype(),
+                            _tobytes() or len(), and it is dumped without _type). Default to False.
+                            Ignored if the bitfield has *init*, *prepack* or *formatter* options.
+        '''
+        params = ['name', 'init', 'extend', 'formatter', 'prepack', 'inline']
         for k in arguments:
             if not k in params:
                 warnings.warn(StructDefWarning('Parameter %r is not recognized, is there a spelling error?' % (k,)))
@@ -3152,6 +4779,14 @@ class bitfield(typedef):
         bs = basetype.parser().sizeof(0)
         if minsize > bs:
             raise ValueError('Bit-fields need %d bytes, underline type has only %d bytes' % (minsize, bs))
+        self.endian = getattr(basetype, '_endian', None)
+        inlineself = arguments.get('inline', False) and self.initfunc is None and self.prepackfunc is None \
+                        and 'formatter' not in arguments
+        if inlineself and self.endian is not None:
+            # The integer is always unpacked with the endian of the base type
+            self._inline = (_endianformat(self.endian, basetype._format), (((), None, _bitspec(fields, bs * 8)),))
+        else:
+            self._inline = None
         self.formatters = {}
         self.listformatters = {}
         if 'extend' in arguments:
@@ -3172,6 +4807,8 @@ class bitfield(typedef):
             self.extraformatter = arguments['formatter']
     def _compile(self):
         return BitfieldParser(self.basetype.parser(), self.fields, self.initfunc, self, self.prepackfunc)
+    def inline(self):
+        return self._inline
     def isextra(self):
         return self.basetype.isextra()
     def __repr__(self, *args, **kwargs):
@@ -3191,24 +4828,25 @@ class bitfield(typedef):
                         try:
                             current[i] = v(current[i])
                         except:
-                            NamedStruct._logger.log(logging.DEBUG, 'A formatter thrown an exception', exc_info = True)                            
+                            _formattererror()
                 except:
-                    NamedStruct._logger.log(logging.DEBUG, 'A formatter thrown an exception', exc_info = True)
+                    _formattererror()
             for k,v in self.formatters.items():
                 try:
                     dumpvalue[k] = v(dumpvalue[k])
                 except:
-                    NamedStruct._logger.log(logging.DEBUG, 'A formatter thrown an exception', exc_info = True)
+                    _formattererror()
             v2 = val
             while v2:
                 if hasattr(v2, '_seqs'):
-                    for s in v2._seqs:
+                    for i in range(0, len(v2._seqs)):
+                        s = _embeddedstruct(v2, i)
                         st = s._gettype()
                         if st is not None and hasattr(st, 'formatdump'):
                             dumpvalue = st.formatdump(dumpvalue, s)
                 v2 = getattr(v2, '_sub', None)
         except:
-            NamedStruct._logger.log(logging.DEBUG, 'A formatter thrown an exception', exc_info = True)
+            _formattererror()
         return dumpvalue
     def _reorder_properties(self, unordered_dict, ordered_dict, val):
         for _, name in self.fields:
@@ -3239,16 +4877,7 @@ class VariantParser(Parser):
                 s._seqs.append(h)
         else:
             start = 0
-        subp = None
-        clsfr = self.classifier
-        if clsfr is not None:
-            clsvalue = clsfr(s)
-            subp = self.subindices.get(clsvalue)
-        if subp is None:
-            for sc in self.subclasses:
-                if sc.isinstance(s):
-                    subp = sc
-                    break
+        subp = self._findsubclass(s)
         if subp is None:
             return start
         else:
@@ -3330,7 +4959,8 @@ class nvariant(typedef):
         :param prepackfunc: same as *nstruct*
         '''
         self.subclasses = []
-        self.classifier = classifier
+        self.subindices = {}
+        self.classifier = classifier._func if isinstance(classifier, Expr) else classifier
         self.prepackfunc = prepackfunc
         self.padding = padding
         self.header = header
@@ -3357,10 +4987,7 @@ class nvariant(typedef):
             hp = self.header.parser()
         else:
             hp = None
-        self._parser = VariantParser(self, hp, self.classifier, self.prepackfunc, self.padding)
-        for sc in self.subclasses:
-            sc.parser()
-        return self._parser
+        return VariantParser(self, hp, self.classifier, self.prepackfunc, self.padding)
     def isextra(self):
         return False
     def __repr__(self, *args, **kwargs):
@@ -3371,9 +4998,7 @@ class nvariant(typedef):
     def formatdump(self, dumpvalue, val):
         return nstruct._formatdump(self, dumpvalue, val)
     def derive(self, newchild):
-        self.subclasses.append(newchild)
-        if hasattr(self, '_parser'):
-            newchild.parser()
+        _derive(self, newchild)
     def _reorder_properties(self, unordered_dict, ordered_dict, val):
         t = val._seqs[0]._gettype()
         if t is not None and hasattr(t, '_reorder_properties'):
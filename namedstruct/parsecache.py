@@ -0,0 +1,175 @@
+'''
+Optional parse cache for repeated identical messages.
+
+The cache is enabled per type. enable_cache() puts a LRU cache in front of parse() and create()
+of the type (including its sub-class types, and when the type is parsed as a field of another
+type), other types are not affected at all. Results are cached by the bytes they are parsed from::
+
+    from namedstruct import enable_cache, cache_stats
+    enable_cache(ofp_oxm, maxentries = 4096)
+    ...
+    print(cache_stats()[ofp_oxm])
+
+parse() does not know the size of the struct before parsing, so the cache looks up the buffer
+prefixes with the sizes of the recently cached results. A struct is only parsed from the bytes
+it uses, so the same prefix always gives the same result.
+
+By default a copy of the cached struct is returned (see NamedStruct._clone()), so the result can
+be modified freely. With copy = False the cached struct itself is returned: it is shared by all
+the results from the same bytes and MUST NOT be modified.
+
+Embedded structs (parsed with an inlineparent) are never cached. Enable the cache after all the
+sub-class types are defined: cached results are not sub-classed again. In zero-copy mode (see
+namedstruct.zerocopy), the cached structs are materialized, so they never reference the parsed buffers.
+
+Created on 2026/10/18
+
+:author: hubo
+'''
+from __future__ import absolute_import
+import threading
+import namedstruct.namedstruct as _ns
+from namedstruct.namedstruct import OrderedDict, _copy
+
+# Number of different sizes probed by parse()
+_MAX_SIZES = 8
+
+_caches = {}
+
+_caches_lock = threading.Lock()
+
+
+class _ParseCache(object):
+    def __init__(self, parser, maxentries, maxbytes, copy):
+        self.parser = parser
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.copy = copy
+        self.entries = OrderedDict()
+        self.sizes = ()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+    def _get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+        return entry
+    def _put(self, key, entry):
+        with self.lock:
+            self.misses += 1
+            if key is None or key in self.entries:
+                return
+            self.entries[key] = entry
+            self.bytes += len(key[1])
+            while self.entries and (len(self.entries) > self.maxentries or self.bytes > self.maxbytes):
+                k, _ = self.entries.popitem(False)
+                self.bytes -= len(k[1])
+                self.evictions += 1
+            if key[0] == 'p' and len(key[1]) not in self.sizes:
+                self.sizes = ((len(key[1]),) + self.sizes)[:_MAX_SIZES]
+    def _result(self, s):
+        if self.copy and isinstance(s, _ns.NamedStruct):
+            return s._clone()
+        return s
+    def _entry(self, s):
+        # Cached structs must not reference the source buffer in zero-copy mode
+        s = self._result(s)
+        if getattr(_ns._zerocopy, 'enabled', False):
+            s = _ns.materialize(s)
+        return s
+    def parse(self, buffer, inlineparent = None):
+        parser = self.parser
+        if inlineparent is not None:
+            return type(parser).parse(parser, buffer, inlineparent)
+        for l in self.sizes:
+            if len(buffer) >= l:
+                entry = self._get(('p', _copy(buffer[:l])))
+                if entry is not None:
+                    return (self._result(entry[0]), entry[1])
+        r = type(parser).parse(parser, buffer, None)
+        if r is None:
+            self._put(None, None)
+        else:
+            self._put(('p', _copy(buffer[:r[1]])), (self._entry(r[0]), r[1]))
+        return r
+    def create(self, data, inlineparent = None):
+        parser = self.parser
+        if inlineparent is not None:
+            return type(parser).create(parser, data, inlineparent)
+        key = ('c', _copy(data))
+        entry = self._get(key)
+        if entry is not None:
+            return self._result(entry[0])
+        r = type(parser).create(parser, data, None)
+        self._put(key, (self._entry(r), None))
+        return r
+
+
+def _rootparser(typedef):
+    p = typedef.parser()
+    if not isinstance(p, _ns.Parser):
+        raise TypeError('%r is not a struct type' % (typedef,))
+    while p.base is not None:
+        p = p.base
+    return p
+
+
+def enable_cache(typedef, maxentries = 1024, maxbytes = 1048576, copy = True):
+    '''
+    Cache the parse results of a type. If the cache is already enabled, it is replaced by an empty one.
+
+    :param typedef: a struct type. The cache is shared by the type, its base types and its sub-class types.
+
+    :param maxentries: max number of cached structs
+
+    :param maxbytes: max total size of the bytes the cached structs are parsed from
+
+    :param copy: if True, return a copy of the cached struct; if False, return the cached struct
+                 itself, which must not be modified.
+    '''
+    p = _rootparser(typedef)
+    cache = _ParseCache(p, maxentries, maxbytes, copy)
+    with _caches_lock:
+        _caches[p] = cache
+        # Instance attributes hide the class methods of this parser only
+        p.parse = cache.parse
+        p.create = cache.create
+
+
+def disable_cache(typedef):
+    '''
+    Remove the cache of a type and restore the original methods.
+    '''
+    p = _rootparser(typedef)
+    with _caches_lock:
+        if _caches.pop(p, None) is not None:
+            del p.parse
+            del p.create
+
+
+def cache_stats(reset = False):
+    '''
+    Get the counters of the enabled caches.
+
+    :param reset: if True, clear the counters (but not the cached structs) after the snapshot is taken.
+
+    :returns: a dictionary {type: (hits, misses, evictions, entries, bytes)}, where *type* is the
+              typedef of the cached parser (the base type if the cache is enabled on a sub-class type)
+    '''
+    result = {}
+    with _caches_lock:
+        caches = list(_caches.values())
+    for c in caches:
+        with c.lock:
+            result[c.parser.typedef] = (c.hits, c.misses, c.evictions, len(c.entries), c.bytes)
+            if reset:
+                c.hits = 0
+                c.misses = 0
+                c.evictions = 0
+    return result
@@ -0,0 +1,188 @@
+'''
+Packed container for a lot of messages of the same type.
+
+A RecordBatch stores the packed bytes of the records back to back in one bytearray, with an
+offset index, instead of keeping a NamedStruct object tree for every record. The records are
+parsed when they are accessed::
+
+    from namedstruct import RecordBatch
+    batch = RecordBatch(ofp_flow_stats)
+    batch.extend_bytes(reply_body)
+    for stats in batch[1000:1050]:
+        print(stats.priority)
+    high = batch.filter(lambda x: x.priority > 100, ofp_flow_stats_header)
+
+The memory used by a batch is the size of the packed records, plus 8 bytes for each record.
+
+Created on 2026/10/18
+
+:author: hubo
+'''
+from __future__ import absolute_import
+from array import array
+
+try:
+    array('Q')
+    _OFFSET_TYPE = 'Q'
+except ValueError:
+    _OFFSET_TYPE = 'L'
+
+
+class RecordBatch(object):
+    '''
+    A sequence of records of a type, stored as packed bytes. Indexing and iteration parse the records
+    on demand (a new struct is created on every access, so modifying it does not change the batch);
+    slicing, filter() and concatenation create new batches.
+    '''
+    def __init__(self, typedef, data = None):
+        '''
+        :param typedef: type of the records
+
+        :param data: if not None, the records are parsed from the bytes with extend_bytes()
+        '''
+        self.typedef = typedef
+        self._data = bytearray()
+        self._offsets = array(_OFFSET_TYPE, [0])
+        if data is not None:
+            self.extend_bytes(data)
+    def __len__(self):
+        return len(self._offsets) - 1
+    def append(self, obj):
+        '''
+        Pack a struct (or other value of the type) and append it to the batch.
+        '''
+        self._data += self.typedef.tobytes(obj)
+        self._offsets.append(len(self._data))
+    def append_bytes(self, data):
+        '''
+        Append the packed bytes of one record without parsing them.
+        '''
+        self._data += data
+        self._offsets.append(len(self._data))
+    def extend_bytes(self, data):
+        '''
+        Append records from a buffer of records packed back to back. Every record is framed with
+        parse() of the type, so the record boundaries are checked.
+
+        :returns: number of bytes used. If it is less than len(data), the remaining bytes are an
+                  incomplete record, e.g. from a stream which is not completely received.
+        '''
+        parser = self.typedef.parser()
+        view = memoryview(data)
+        start = 0
+        end = len(view)
+        while start < end:
+            r = parser.parse(view[start:])
+            if r is None:
+                break
+            # The padding of the last record may be missing from data
+            size = min(r[1], end - start)
+            if size <= 0:
+                break
+            self._data += view[start:start + size]
+            self._offsets.append(len(self._data))
+            start += size
+        return start
+    def getbytes(self, i):
+        '''
+        :returns: packed bytes of the record *i*
+        '''
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('record index out of range')
+        return bytes(self._data[self._offsets[i]:self._offsets[i + 1]])
+    def _record(self, i):
+        # Parse from a private copy of the record, so no buffer of the bytearray is exported
+        data = memoryview(self._data[self._offsets[i]:self._offsets[i + 1]])
+        return self.typedef.parser().parse(data)[0]
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return self._select(range(start, stop, step))
+            batch = RecordBatch(self.typedef)
+            if start < stop:
+                base = self._offsets[start]
+                batch._data = self._data[base:self._offsets[stop]]
+                batch._offsets = array(_OFFSET_TYPE, [o - base for o in self._offsets[start:stop + 1]])
+            return batch
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('record index out of range')
+        return self._record(i)
+    def __iter__(self):
+        for i in range(0, len(self)):
+            yield self._record(i)
+    def views(self):
+        '''
+        Iterate the packed bytes of the records as memoryview objects, without copying. The batch
+        cannot be extended until all the views are released.
+        '''
+        view = memoryview(self._data)
+        offsets = self._offsets
+        for i in range(0, len(offsets) - 1):
+            yield view[offsets[i]:offsets[i + 1]]
+    def peek(self, i, peektype):
+        '''
+        Parse the beginning of the record *i* with another type, usually a fixed size header type,
+        which is much cheaper than parsing the whole record.
+
+        :returns: the parsed value, or None if the record is shorter than *peektype*
+        '''
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('record index out of range')
+        r = peektype.parser().parse(memoryview(self._data[self._offsets[i]:self._offsets[i + 1]]))
+        return None if r is None else r[0]
+    def _select(self, indices):
+        batch = RecordBatch(self.typedef)
+        for i in indices:
+            batch._data += self._data[self._offsets[i]:self._offsets[i + 1]]
+            batch._offsets.append(len(batch._data))
+        return batch
+    def filter(self, predicate, peektype = None):
+        '''
+        Select records with a predicate.
+
+        :param predicate: a function which returns True for the records to keep
+
+        :param peektype: if not None, the predicate is called with peek(i, peektype) instead of the
+                         fully parsed record
+
+        :returns: a new RecordBatch
+        '''
+        if peektype is None:
+            return self._select(i for i in range(0, len(self)) if predicate(self._record(i)))
+        else:
+            return self._select(i for i in range(0, len(self)) if predicate(self.peek(i, peektype)))
+    def _checktype(self, other):
+        if other.typedef is not self.typedef:
+            raise TypeError('cannot concatenate RecordBatch of %r and RecordBatch of %r' % (self.typedef, other.typedef))
+    def __add__(self, other):
+        if not isinstance(other, RecordBatch):
+            return NotImplemented
+        self._checktype(other)
+        batch = RecordBatch(self.typedef)
+        batch._data = self._data + other._data
+        batch._offsets = array(_OFFSET_TYPE, self._offsets)
+        base = len(self._data)
+        batch._offsets.extend(o + base for o in other._offsets[1:])
+        return batch
+    def __iadd__(self, other):
+        if not isinstance(other, RecordBatch):
+            return NotImplemented
+        self._checktype(other)
+        base = len(self._data)
+        self._data += other._data
+        self._offsets.extend(o + base for o in other._offsets[1:])
+        return self
+    def tobytes(self):
+        '''
+        :returns: all the packed records
+        '''
+        return bytes(self._data)
+    def __repr__(self, *args, **kwargs):
+        return '<RecordBatch of %r: %d records, %d bytes>' % (self.typedef, len(self), len(self._data))
@@ -24,4 +24,5 @@ setup(name='nstruct',
       test_suite = 'tests',
       use_2to3=False,
       install_requires = [],
+      entry_points = {'console_scripts': ['nstruct-profile = namedstruct.profiler:main']},
       packages=find_packages(exclude=("tests","tests.*","misc","misc.*")))
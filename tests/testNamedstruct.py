@@ -5,6 +5,7 @@ Created on 2016/1/19
 '''
 from __future__ import print_function
 import unittest
+import sys
 from namedstruct import *
 from pprint import pprint
 
@@ -228,7 +229,720 @@ class Test(unittest.TestCase):
         self.assertEqual(s2.array[2].a, 3)
         self.assertEqual(s2.array[3].text, b'def')
         self.assertEqual(s2.array[4].subarray, [1,2,3])
-        
+    def testStats(self):
+        s1 = nstruct((uint16, 'length'),
+                     (uint8, 'type'),
+                     name = 's1',
+                     padding = 1,
+                     size = lambda x: x.length,
+                     prepack = packrealsize('length'))
+        s2 = nstruct((uint16, 'a'), base = s1, criteria = lambda x: x.type == 1, init = packvalue(1, 'type'), name = 's2')
+        b = s2(a = 3)._tobytes()
+        reset_stats()
+        enable_stats()
+        try:
+            s1.parse(b)
+            s1.create(b)
+            s1.parse(b[:2])
+            s2(a = 4)._tobytes()
+            dump(s1.create(b))
+        finally:
+            disable_stats()
+        r = stats(True)
+        self.assertEqual(r[s2]['parse'][:2], (1, 5))
+        self.assertEqual(r[s2]['create'][:2], (2, 10))
+        self.assertEqual(r[s2]['tobytes'][:2], (1, 5))
+        self.assertEqual(r[s2]['dump'][0], 1)
+        self.assertEqual(r[s1]['parse'][:2], (1, 0))
+        self.assertEqual(stats(), {})
+        s1.parse(b)
+        self.assertEqual(stats(), {})
+    def testProfileParse(self):
+        from namedstruct.profiler import profile_parse, _ProfiledParser
+        s1 = nstruct((uint8, 'length'),
+                     (raw, 'data'),
+                     size = lambda x: x.length + 1,
+                     prepack = packexpr(lambda x: len(x.data), 'length'),
+                     name = 's1',
+                     padding = 1)
+        s2 = nstruct((uint16, 'size'),
+                     (darray(s1, 'strings', lambda x: x.size),),
+                     (optional(uint32, 'extra', lambda x: x.size > 1),),
+                     name = 's2',
+                     prepack = packexpr(lambda x:len(x.strings), 'size'),
+                     padding = 1)
+        b = s2(strings = [s1(data = b'abc'), s1(data = b'de')], extra = 7)._tobytes()
+        r = profile_parse(s2, b, repeat = 3, stream = None)
+        self.assertEqual(r.nodes[('s2',)][0], 3)
+        self.assertEqual(r.nodes[('s2', '(' + repr(s2.seqs[1][0]) + ')', 'strings[]')][0], 6)
+        self.assertEqual(r.nodes[('s2', '(' + repr(s2.seqs[1][0]) + ')', 'strings[]', 'size()')][0], 6)
+        self.assertEqual(r.nodes[('s2', '(' + repr(s2.seqs[2][0]) + ')', 'criteria(extra)')][0], 3)
+        self.assertGreaterEqual(r.inclusive(('s2',)), r.exclusive(('s2',)))
+        self.assertIn('strings[]', r.format())
+        # Instrumentation is removed
+        self.assertEqual(s2.parse(b)[0].extra, 7)
+        self.assertFalse(any(isinstance(p, _ProfiledParser) for p, _ in s2.parser().parserseq))
+    def testFootprint(self):
+        from namedstruct.footprint import footprint, footprint_report
+        s1 = nstruct((uint16, 'a'),
+                     (uint8[0], 'b'),
+                     name = 's1',
+                     padding = 1)
+        s2 = nstruct((uint16, 'length'),
+                     (s1, 'inner'),
+                     name = 's2',
+                     padding = 1,
+                     size = lambda x: x.length,
+                     prepack = packrealsize('length'))
+        s = s2(inner = s1(a = 1, b = [1,2,3]))
+        f = footprint(s)
+        self.assertEqual(f.types[s1][0], 1)
+        self.assertEqual(f.types[s2][0], 1)
+        self.assertGreater(f.fields[(s1, 'b')], 0)
+        self.assertEqual(f.fields[(s2, 'inner')], 0)
+        self.assertEqual(f.total, sum(v[1] for v in f.types.values()) + sum(f.fields.values()))
+        f2 = footprint([s, s])
+        self.assertEqual(f2.total, f.total + sys.getsizeof([s, s]))
+        b = s._tobytes()
+        r = footprint_report(s2, [b, b])
+        self.assertEqual(r.samples, 2)
+        self.assertEqual(r.footprint.types[s2][0], 2)
+        self.assertIn('s1', r.format())
+    def testLazySubclass(self):
+        s1 = nstruct((uint8, 'type'),
+                     (uint8, 'subtype'),
+                     name = 's1',
+                     padding = 1,
+                     classifier = lambda x: x.type)
+        s2 = nstruct((uint16, 'a'), base = s1, classifyby = (1,), name = 's2', init = packvalue(1, 'type'))
+        s3 = nstruct((uint8, 'b'), base = s1, criteria = lambda x: x.subtype == 1, name = 's3', init = packvalue(1, 'subtype'))
+        s1.parser()
+        self.assertFalse(hasattr(s2, '_parser'))
+        self.assertFalse(hasattr(s3, '_parser'))
+        r = s1.create(b'\x01\x00\x00\x02')
+        self.assertEqual(r._gettype(), s2)
+        self.assertEqual(r.a, 2)
+        self.assertTrue(hasattr(s2, '_parser'))
+        self.assertFalse(hasattr(s3, '_parser'))
+        r = s1.create(b'\x00\x01\x03')
+        self.assertEqual(r._gettype(), s3)
+        self.assertEqual(r.b, 3)
+        # A type defined later replaces the compiled sub-class with the same classify value
+        s4 = nstruct((uint8, 'c'), base = s1, classifyby = (1,), name = 's4', init = packvalue(1, 'type'))
+        r = s1.create(b'\x01\x00\x05')
+        self.assertEqual(r._gettype(), s4)
+        self.assertEqual(r.c, 5)
+    def testStaticSize(self):
+        s1 = nstruct((uint16, 'a'),
+                     (uint8, 'b'),
+                     name = 's1',
+                     padding = 4,
+                     init = packvalue(1, 'a'))
+        s2 = nstruct((uint32, 'length'),
+                     (s1[1000], 'items'),
+                     (bitfield_test, 'color'),
+                     (s1[0], 'rest'),
+                     name = 's2',
+                     padding = 1,
+                     size = lambda x: x.length,
+                     prepack = packrealsize('length'))
+        s3 = nstruct((s1[2], 'items'), (uint8[3],), name = 's3', padding = 8)
+        self.assertEqual(s1.static_size(), 4)
+        self.assertEqual(bitfield_test.static_size(), 4)
+        self.assertEqual(uint16[3].static_size(), 6)
+        self.assertEqual(s3.static_size(), 16)
+        self.assertEqual(s2.static_size(), None)
+        self.assertEqual(raw.static_size(), None)
+        self.assertEqual(cstr.static_size(), None)
+        s = s2(rest = [s1(b = 1), s1(b = 2)])
+        b = s._tobytes()
+        self.assertEqual(len(b), 4 + 4000 + 4 + 8)
+        self.assertEqual(len(s), len(b))
+        self.assertEqual(s2.create(b).length, len(b))
+        # Sub-classing makes the size dynamic
+        s4 = nstruct((uint16, 'c'), base = s1, criteria = lambda x: x.a == 2, name = 's4', init = packvalue(2, 'a'))
+        self.assertEqual(s1.static_size(), None)
+        self.assertEqual(s3.static_size(), None)
+        s = s2(rest = [s1(b = 1), s4(c = 2)])
+        self.assertEqual(len(s), 4 + 4000 + 4 + 4 + 8)
+        self.assertEqual(len(s), len(s._tobytes()))
+    def testFlattenRuns(self):
+        s1 = nstruct((uint8, 'type'),
+                     name = 's1',
+                     padding = 1,
+                     init = packvalue(1, 'type'))
+        s2 = nstruct((uint16, 'a'),
+                     (uint8[2], 'b'),
+                     (optional(uint32, 'c', lambda x: x.a == 1),),
+                     (uint16, 'd'),
+                     (s1,),
+                     (char[3], 'e'),
+                     (raw, 'f'),
+                     name = 's2',
+                     padding = 1)
+        s = s2(a = 1, b = [2, 3], c = 4, d = 5, e = b'ab', f = b'xyz')
+        b = s._tobytes()
+        self.assertEqual(b, b'\x00\x01\x02\x03\x00\x00\x00\x04\x00\x05\x01ab\x00xyz')
+        self.assertEqual(len(s), len(b))
+        r = s2.create(b)
+        # Fixed size runs are unpacked into the struct directly
+        self.assertEqual(r._seqs[0], None)
+        self.assertEqual(r._seqs[2], None)
+        self.assertEqual(r._get_embedded(s1)._tobytes(), b'\x01')
+        self.assertEqual(dump(r, False), dump(s, False))
+        self.assertEqual(list(dump(r).keys()), ['a', 'b', 'c', 'd', 'type', 'e', 'f', '_type'])
+        self.assertEqual(s2.parse(b[:5]), None)
+        r = s2.create(b'\x00\x02\x00\x00\x00\x07\x01abc')
+        self.assertFalse(hasattr(r, 'c'))
+        self.assertEqual(r.d, 7)
+        self.assertEqual(r.e, b'abc')
+    def testFlattenEmbedded(self):
+        h = nstruct((uint16, 'type'),
+                    (uint16, 'length'),
+                    name = 'h',
+                    padding = 1,
+                    init = packvalue(1, 'type'),
+                    prepack = packrealsize('length'),
+                    extend = {'type': enum('htype', None, uint16, A = 1)})
+        s1 = nstruct((h,), (uint8[0], 'data'), name = 's1', padding = 1)
+        s2 = nstruct((h,), (uint8[0], 'data'), name = 's2', padding = 1, flatten = False)
+        for t in (s1, s2):
+            s = t(data = [1, 2])
+            self.assertEqual(s._tobytes(), b'\x00\x01\x00\x04\x01\x02')
+            r = t.create(s._tobytes())
+            self.assertEqual(dump(r), {'_type': '<' + t.readablename + '>', 'type': 'A', 'length': 4, 'data': [1, 2]})
+            self.assertEqual(len(r), 6)
+        # Embedded struct is created only when requested
+        r = s1.create(b'\x00\x01\x00\x04\x01\x02')
+        self.assertEqual(r._seqs, [None])
+        e = r._get_embedded(h)
+        self.assertIs(r._get_embedded(h), e)
+        self.assertEqual(e._tobytes(True), b'\x00\x01\x00\x04')
+        e.type = 2
+        self.assertEqual(r._tobytes(), b'\x00\x02\x00\x04\x01\x02')
+        self.assertIsNot(s2.create(b'\x00\x01\x00\x04')._seqs[0], None)
+        # A type with sub-classes is not flattened any more
+        h2 = nstruct(base = h, criteria = lambda x: x.type == 2, name = 'h2', init = packvalue(2, 'type'))
+        r2 = s1.create(b'\x00\x02\x00\x04\x03')
+        self.assertIsNot(r2._seqs[0], None)
+        self.assertIs(r2._get_embedded(h)._gettype(), h2)
+        self.assertEqual(r2.data, [3])
+        self.assertEqual(r._tobytes(), b'\x00\x02\x00\x04\x01\x02')
+    def testPrototypeNew(self):
+        inner = nstruct((uint16, 'x'), (uint8[2], 'y'), name = 'inner', padding = 1)
+        s1 = nstruct((uint8, 'a'), (uint16[3], 'b'), (inner, 'c'), (char[4], 'd'),
+                     name = 's1', padding = 1, init = packvalue(2, 'c', 'x'))
+        r1 = s1()
+        r2 = s1(a = 1)
+        self.assertEqual(dump(r1, False, typeinfo = DUMPTYPE_NONE), {'a': 0, 'b': [0, 0, 0], 'c': {'x': 2, 'y': [0, 0]}, 'd': b''})
+        # Lists and inlined structs are not shared
+        r1.b[0] = 5
+        r1.c.y.append(1)
+        self.assertIsNot(r1.c, r2.c)
+        self.assertEqual(dump(r2, False, typeinfo = DUMPTYPE_NONE), {'a': 1, 'b': [0, 0, 0], 'c': {'x': 2, 'y': [0, 0]}, 'd': b''})
+        self.assertEqual(s1()._tobytes(), b'\x00' * 7 + b'\x00\x02' + b'\x00' * 6)
+        c1 = bitfield_array.new()
+        c1.bits[0] = 1
+        self.assertEqual(bitfield_array.new().bits, [0] * 50)
+        self.assertEqual(bitfield_test.new()._tobytes(), b'\x80\x00\x00\x00')
+    def testClone(self):
+        import copy
+        h = nstruct((uint8, 'type'), (uint8, 'length'), name = 'h', padding = 1)
+        e = nstruct((uint16, 'v'), (raw, 'r'), name = 'e', padding = 1, size = lambda x: 2)
+        inner = nstruct((uint8, 'x'), name = 'inner', padding = 1)
+        s1 = nstruct((h,), (e,), name = 's1', padding = 1, classifier = lambda x: x.type,
+                     size = lambda x: x.length, prepack = packrealsize('length'))
+        s2 = nstruct((inner[0], 'items'), (uint8[2], 'pair'), base = s1, classifyby = (2,), name = 's2',
+                     init = packvalue(2, 'type'))
+        s = s2(v = 7, items = [inner(x = 1), inner(x = 2)], pair = [3, 4])
+        b = s._tobytes()
+        for c in (copy.copy(s), copy.deepcopy(s)):
+            self.assertIs(c._gettype(), s2)
+            self.assertEqual(c._tobytes(), b)
+            self.assertEqual(dump(c), dump(s))
+            self.assertIsNot(c.items, s.items)
+            self.assertIsNot(c.items[0], s.items[0])
+            self.assertIs(c._get_embedded(e)._target, c)
+            c.items[0].x = 5
+            c.pair[0] = 6
+            c._get_embedded(e).v = 8
+            self.assertEqual(s._tobytes(), b)
+        # Types are copied, not parsed again
+        s.type = 3
+        c = copy.copy(s)
+        self.assertIs(c._gettype(), s2)
+        self.assertEqual(c.pair, [3, 4])
+    def testParseInto(self):
+        inner = nstruct((uint16, 'x'), (uint8, 'y'), name = 'inner', padding = 1)
+        s1 = nstruct((uint8, 'type'), (uint8, 'length'), (inner, 'c'), name = 's1', padding = 1,
+                     classifier = lambda x: x.type, size = lambda x: x.length, prepack = packrealsize('length'))
+        s2 = nstruct((uint16, 'a'), base = s1, classifyby = (2,), name = 's2', init = packvalue(2, 'type'))
+        s3 = nstruct((optional(uint8, 'b', lambda x: x.type == 3),), base = s1, classifyby = (3, 4), name = 's3')
+        r = s1.create(b'\x01\x05\x00\x05\x06')
+        c = r.c
+        self.assertEqual(s1.parse_into(r, b'\x01\x05\x00\x07\x08\xff'), (r, 5))
+        self.assertEqual(dump(r, False, typeinfo = DUMPTYPE_NONE), {'type': 1, 'length': 5, 'c': {'x': 7, 'y': 8}})
+        self.assertIs(r.c, c)
+        # Sub-class parts are replaced
+        self.assertEqual(s1.parse_into(r, b'\x02\x07\x00\x07\x08\x00\x09'), (r, 7))
+        self.assertIs(r._gettype(), s2)
+        self.assertEqual(r.a, 9)
+        self.assertEqual(s1.parse_into(r, b'\x03\x06\x00\x07\x08\x0a'), (r, 6))
+        self.assertIs(r._gettype(), s3)
+        self.assertEqual(r.b, 10)
+        self.assertFalse(hasattr(r, 'a'))
+        self.assertEqual(s1.parse_into(r, b'\x04\x05\x00\x07\x08'), (r, 5))
+        self.assertFalse(hasattr(r, 'b'))
+        self.assertEqual(r._tobytes(), b'\x04\x05\x00\x07\x08')
+        self.assertEqual(s1.parse_into(r, b'\x04\x05\x00'), None)
+        self.assertRaises(ValueError, s1.parse_into, inner(), b'\x00\x00\x00')
+        # Free list
+        r2, _ = s2.parse_into(None, b'\x02\x07\x00\x07\x08\x00\x09')
+        self.assertIsNot(r2, r)
+        s1.release(r)
+        self.assertIsNot(s1.parse_into(None, b'\x01\x05\x00\x07\x08')[0], r)
+        s1.set_freelist(1)
+        s1.release(r)
+        s1.release(r2)
+        r3, _ = s2.parse_into(None, b'\x01\x05\x00\x07\x08')
+        self.assertIs(r3, r)
+        self.assertIs(r3._gettype(), s1)
+        self.assertIsNot(s1.parse_into(None, b'\x01\x05\x00\x07\x08')[0], r2)
+        s1.set_freelist(0)
+        self.assertRaises(TypeError, uint8.parse_into, None, b'\x00')
+    def testParseCache(self):
+        from namedstruct import parsecache
+        tlv = nstruct((uint8, 'type'), (uint8, 'length'), name = 'tlv', padding = 1, classifier = lambda x: x.type,
+                      size = lambda x: x.length, prepack = packrealsize('length'))
+        tlv1 = nstruct((uint16[0], 'values'), base = tlv, classifyby = (1,), name = 'tlv1', init = packvalue(1, 'type'))
+        msg = nstruct((uint16, 'length'), (tlv[0], 'tlvs'), name = 'msg', padding = 1,
+                      size = lambda x: x.length, prepack = packrealsize('length'))
+        m = msg(tlvs = [tlv1(values = [1]), tlv1(values = [2, 3]), tlv1(values = [1]), tlv(type = 2)])
+        b = m._tobytes()
+        parsecache.enable_cache(tlv1, maxentries = 2)
+        try:
+            self.assertIs(tlv.parser().parse, tlv1.parser().base.parse)
+            for _ in range(0, 2):
+                r = msg.create(b)
+                self.assertEqual(dump(r), dump(m))
+                self.assertIs(r.tlvs[0]._gettype(), tlv1)
+                self.assertIsNot(r.tlvs[0], r.tlvs[2])
+            # 4 + 4 tlvs, 2 entries: [1], [2, 3] evicted by tlv(2) then parsed again
+            self.assertEqual(parsecache.cache_stats()[tlv], (3, 5, 3, 2, 6))
+            r.tlvs[2].values.append(4)
+            self.assertEqual(msg.create(b).tlvs[2].values, [1])
+            self.assertEqual(tlv.create(b'\x01\x04\x00\x05')._tobytes(), b'\x01\x04\x00\x05')
+            self.assertIsNot(tlv.create(b'\x01\x04\x00\x05'), tlv.create(b'\x01\x04\x00\x05'))
+            self.assertEqual(tlv.parse(b'\x01\x04\x00'), None)
+            parsecache.enable_cache(tlv, copy = False)
+            self.assertEqual(parsecache.cache_stats(reset = True)[tlv], (0, 0, 0, 0, 0))
+            self.assertIs(tlv.parse(b'\x01\x04\x00\x05\xff')[0], tlv.parse(b'\x01\x04\x00\x05\xfe')[0])
+            self.assertEqual(parsecache.cache_stats()[tlv], (1, 1, 0, 1, 4))
+        finally:
+            parsecache.disable_cache(tlv)
+        self.assertEqual(parsecache.cache_stats(), {})
+        self.assertNotIn('parse', tlv.parser().__dict__)
+        self.assertRaises(TypeError, parsecache.enable_cache, uint8)
+    def testValueCompare(self):
+        tlv = nstruct((uint8, 'type'), (uint8, 'length'), name = 'tlv', padding = 1, classifier = lambda x: x.type,
+                      size = lambda x: x.length, prepack = packrealsize('length'))
+        tlv1 = nstruct((uint16[0], 'values'), base = tlv, classifyby = (1,), name = 'tlv1', init = packvalue(1, 'type'))
+        self.assertNotEqual(tlv1(values = [1]), tlv1(values = [1]))
+        tlv1.set_compare()
+        a = tlv1(values = [1, 2])
+        b = tlv.create(b'\x01\x06\x00\x01\x00\x02')
+        self.assertEqual(a, b)
+        self.assertEqual(hash(a), hash(b))
+        self.assertEqual(len(set([a, b, tlv1(values = [1])])), 2)
+        d = {(a, tlv1(values = [3])): 1}
+        self.assertEqual(d[(b, tlv.create(b'\x01\x04\x00\x03'))], 1)
+        h = hash(a)
+        a.values = [1, 3]
+        self.assertNotEqual(hash(a), h)
+        self.assertNotEqual(a, b)
+        self.assertEqual(a, tlv1(values = [1, 3]))
+        self.assertNotEqual(a, a._tobytes())
+        # Compare with prepack executed on a copy
+        e = tlv1(values = [1])
+        self.assertEqual(e, tlv1(values = [1], length = 4))
+        self.assertEqual(e.length, 0)
+        # In-place modifications need _rehash()
+        h = hash(a)
+        a.values.append(4)
+        self.assertEqual(hash(a), h)
+        a._rehash()
+        self.assertNotEqual(hash(a), h)
+        self.assertEqual(a, tlv1(values = [1, 3, 4]))
+        # Setting a field through the sub-class part, extra data or parsing again clears the cache
+        h = hash(a)
+        a._sub.values = [1]
+        self.assertNotEqual(hash(a), h)
+        self.assertEqual(a, tlv1(values = [1]))
+        a._setextra(b'\x05')
+        self.assertNotEqual(a, tlv1(values = [1]))
+        tlv.parse_into(a, b'\x01\x04\x00\x03')
+        self.assertEqual(a, tlv1(values = [3]))
+        self.assertEqual(hash(a), hash(tlv1(values = [3])))
+        point = nstruct((uint16, 'x'), name = 'point', padding = 1)
+        point.set_compare()
+        c = point(x = 1)
+        h = hash(c)
+        point.parse_into(c, b'\x00\x02')
+        self.assertEqual(hash(c), hash(point(x = 2)))
+        tlv.set_compare(COMPARE_FIELDS)
+        d = tlv.create(b'\x02\x02')
+        self.assertEqual(d, tlv.create(b'\x02\x02'))
+        self.assertEqual(hash(d), hash(tlv.create(b'\x02\x02')))
+        self.assertNotEqual(d, tlv.create(b'\x02\x02\x00'))
+        self.assertEqual(tlv1(values = [1]), tlv1(values = [1]))
+        self.assertNotEqual(tlv1(values = [1]), tlv1(values = [1], length = 4))
+        self.assertRaises(ValueError, tlv.set_compare, 'other')
+        tlv.set_compare(None)
+        self.assertNotEqual(tlv1(values = [1]), tlv1(values = [1]))
+    def testBulkArray(self):
+        le16 = prim('H', 'le16', '<', True)
+        s = nstruct((uint8, 'a'), (le16[2], 'b'), (uint32[0], 'c'), name = 's', padding = 1)
+        r = s.create(b'\x01\x02\x00\x03\x00\x00\x00\x00\x04\x00\x00\x00\x05\xff')
+        self.assertEqual(r.a, 1)
+        self.assertEqual(r.b, [2, 3])
+        self.assertEqual(r.c, [4, 5])
+        self.assertEqual(s.tobytes(r), b'\x01\x02\x00\x03\x00\x00\x00\x00\x04\x00\x00\x00\x05')
+        self.assertEqual(s(b = [1], c = (6,))._tobytes(), b'\x00\x01\x00\x00\x00\x00\x00\x00\x06')
+        self.assertEqual(len(s(b = [1, 2, 3])), 5)
+        self.assertEqual(s.parse(b'\x01\x02\x00'), None)
+        self.assertEqual(uint16[0].create(b'\x00\x01\x00\x02\x00'), [1, 2])
+        self.assertEqual(uint16[0].tobytes([1, 2]), b'\x00\x01\x00\x02')
+        self.assertEqual(uint8[3].parse(b'\x01\x02\x03\x04'), ([1, 2, 3], 3))
+        self.assertEqual(uint8[3].parse(b'\x01\x02'), None)
+        self.assertEqual(uint8[3].tobytes([1]), b'\x01\x00\x00')
+        self.assertEqual(char[2][0].create(b'abcde'), [b'ab', b'cd'])
+    def testZeroCopy(self):
+        s = nstruct((uint16, 'length'), (cstr, 'name'), (varchr, 'data'), name = 's', padding = 1,
+                    size = lambda x: x.length, prepack = packrealsize('length'))
+        f = nstruct((uint16, 'length'), name = 'f', padding = 1, size = lambda x: x.length)
+        data = bytearray(b'\x00\x09ab\x00cd\x00\x00\x00xyz')
+        self.assertIsInstance(s.parse(memoryview(data))[0].data, bytes)
+        self.assertIsInstance(f.create(memoryview(b'\x00\x04ab'))._extra, bytes)
+        with zerocopy():
+            r = s.parse(memoryview(data))[0]
+            with zerocopy(False):
+                self.assertIsInstance(s.parse(memoryview(data))[0].data, bytes)
+            r2 = f.create(memoryview(b'\x00\x04ab'))
+        self.assertIsInstance(r.name, memoryview)
+        self.assertIsInstance(r.data, memoryview)
+        self.assertIsInstance(r2._extra, memoryview)
+        self.assertEqual(r.name, b'ab')
+        self.assertEqual(r.data, b'cd')
+        self.assertEqual(r._tobytes(), b'\x00\x07ab\x00cd')
+        self.assertEqual(dump(r2, typeinfo = DUMPTYPE_NONE, dumpextra = True), {'length': 4, '_extra': b'ab'})
+        self.assertEqual(f.tobytes(r2), b'\x00\x04ab')
+        self.assertEqual(cstr.tobytes(r.name), b'ab\x00')
+        self.assertEqual(varchr.tobytes(r.data), b'cd')
+        data[2] = ord('x')
+        self.assertEqual(r.name, b'xb')
+        self.assertIs(materialize(r), r)
+        materialize(r2)
+        data[2] = ord('a')
+        self.assertIsInstance(r.name, bytes)
+        self.assertIsInstance(r.data, bytes)
+        self.assertIsInstance(r2._extra, bytes)
+        self.assertEqual(r.name, b'xb')
+        self.assertEqual(materialize([memoryview(b'a')]), [b'a'])
+    def testToBuffers(self):
+        s1 = nstruct((uint16, 'length'), (raw, 'data'), name = 's1', padding = 4,
+                     size = lambda x: x.length, prepack = packrealsize('length'))
+        s2 = nstruct((uint8, 'type'), (s1, 'payload'), (uint32, 'tail'), name = 's2', padding = 8)
+        payload = b'x' * 1024
+        s = s2(type = 1, payload = s1(data = payload), tail = 2)
+        buffers = s._tobuffers()
+        self.assertEqual(b''.join(buffers), s._tobytes())
+        self.assertEqual(len(buffers), 3)
+        self.assertIs(buffers[1], payload)
+        self.assertEqual(buffers[0], b'\x01\x04\x02')
+        self.assertEqual(buffers[2], b'\x00\x00' + b'\x00\x00\x00\x02' + b'\x00' * 7)
+        self.assertEqual(s._tobuffers(minsize = 2048), [s._tobytes()])
+        self.assertEqual(s2()._tobuffers(), [s2()._tobytes()])
+    def testIterBytes(self):
+        s1 = nstruct((uint8, 'length'), (raw, 'data'), name = 's1', padding = 2,
+                     size = lambda x: x.length, prepack = packrealsize('length'))
+        s2 = nstruct((uint16, 'count'), (darray(s1, 'items', lambda x: x.count),), (uint16, 'length'),
+                     (s1[0], 'tail'), name = 's2', padding = 4,
+                     prepack = packexpr(lambda x: len(x.items), 'count'))
+        s = s2(items = [s1(data = b'a' * i) for i in range(0, 20)], tail = [s1(data = b'xyz'), s1()])
+        b = s._tobytes()
+        for chunk_size in (1, 5, 64, 100000):
+            chunks = list(s._iterbytes(chunk_size))
+            self.assertEqual(b''.join(chunks), b)
+            self.assertTrue(all(len(c) == chunk_size for c in chunks[:-1]))
+        s.items.append(s1(data = b'b'))
+        chunks = s._iterbytes(8)
+        self.assertEqual(next(chunks), b'\x00\x15\x01\x00\x02a\x03a')
+        self.assertEqual(b''.join(chunks), s._tobytes()[8:])
+        self.assertEqual(list(s2()._iterbytes()), [s2()._tobytes()])
+    def testTLVList(self):
+        tlv = nstruct((uint8, 'type'), (uint8, 'length'), name = 'tlv', padding = 1, classifier = lambda x: x.type,
+                      size = lambda x: x.length, prepack = packrealsize('length'))
+        tlv1 = nstruct((uint16, 'a'), base = tlv, classifyby = (1,), name = 'tlv1', init = packvalue(1, 'type'))
+        tlv2 = nstruct((uint8[0], 'b'), base = tlv, classifyby = (2,), name = 'tlv2', init = packvalue(2, 'type'))
+        s = nstruct((uint16, 'length'), (tlvlist(tlv, 'BB', lambda h: h[0], lambda h: h[1]), 'items'),
+                    name = 's', padding = 1, size = lambda x: x.length, prepack = packrealsize('length'))
+        data = b'\x00\x0d\x02\x03\x07\x01\x04\x00\x05\x02\x04\x08\x09\xff'
+        r, size = s.parse(data)
+        self.assertEqual(size, 13)
+        self.assertEqual(len(r.items), 3)
+        self.assertEqual(r.items._items, [None, None, None])
+        self.assertEqual(r.items.get(1).a, 5)
+        self.assertEqual(r.items._items[0], None)
+        self.assertEqual(r.items.get(3), None)
+        self.assertEqual([i.b for i in r.items.getall(2)], [[7], [8, 9]])
+        self.assertEqual(r._tobytes(), data[:13])
+        r.items[1].a = 6
+        del r.items[0]
+        r.items.append(tlv1(a = 7))
+        self.assertEqual(r.items.get(1).a, 6)
+        self.assertEqual([i.a for i in r.items.getall(1)], [6, 7])
+        self.assertEqual(r.items._keys[2], 1)
+        r.items[2] = tlv2(b = [3])
+        self.assertEqual([i.b for i in r.items.getall(2)], [[8, 9], [3]])
+        r.items[2] = tlv1(a = 7)
+        self.assertEqual(r._tobytes(), b'\x00\x0e\x01\x04\x00\x06\x02\x04\x08\x09\x01\x04\x00\x07')
+        self.assertEqual(dump(r, typeinfo = DUMPTYPE_NONE)['items'][2], {'type': 1, 'length': 4, 'a': 7})
+        c = r._clone()
+        c.items[0].a = 1
+        self.assertEqual(r.items[0].a, 6)
+        self.assertIsNot(c.items[1], r.items[1])
+        self.assertEqual(c.items[1].b, [8, 9])
+        r2 = s(items = [tlv2(b = [1])])
+        self.assertEqual(r2._tobytes(), b'\x00\x05\x02\x03\x01')
+        self.assertEqual(s.create(r2._tobytes()).items.get(2).b, [1])
+        self.assertRaises(ValueError, s.create, b'\x00\x04\x01\x00')
+    def testLazyArray(self):
+        point = nstruct((uint16, 'x'), (uint16, 'y'), name = 'point', padding = 1)
+        item = nstruct((uint16, 'length'), (raw, 'data'), name = 'item', padding = 2,
+                       size = lambda x: x.length, prepack = packrealsize('length'))
+        points = lazyarray(point)
+        r = points.create(b'\x00\x01\x00\x02\x00\x03\x00\x04\x00\x05\x00\x06\x00')
+        self.assertIsInstance(r, LazyList)
+        self.assertEqual(len(r), 3)
+        self.assertEqual(r._items, [None, None, None])
+        self.assertEqual(r[-1].y, 6)
+        self.assertEqual([p.x for p in r[:2]], [1, 3])
+        self.assertEqual(points.tobytes(r), b'\x00\x01\x00\x02\x00\x03\x00\x04\x00\x05\x00\x06')
+        self.assertRaises(TypeError, lazyarray(item).parser)
+        s = nstruct((uint8, 'count'), (lazyarray(item, 'H', lambda h: (h[0] + 1) // 2 * 2, cache = False), 'items'),
+                    name = 's', padding = 1, prepack = packexpr(lambda x: len(x.items), 'count'))
+        r = s.create(b'\x03\x00\x03a\x00\x00\x02\x00\x05bcd\x00')
+        self.assertEqual(r.count, 3)
+        self.assertEqual([i.data for i in r.items], [b'a', b'', b'bcd'])
+        self.assertEqual(r.items._items, [None, None, None])
+        r.items[0] = item(data = b'xy')
+        del r.items[1]
+        self.assertEqual(r._tobytes(), b'\x02\x00\x04xy\x00\x05bcd\x00')
+        self.assertIsNot(r.items[1], r.items[1])
+        # Uncached elements are read-only, the changes would be lost
+        e = r.items[1]
+        self.assertRaises(TypeError, setattr, e, 'data', b'x')
+        self.assertRaises(TypeError, e._setextra, b'x')
+        c = e._clone()
+        c.data = b'xyz'
+        r.items[1] = c
+        self.assertEqual(r.items._sizes[1], None)
+        self.assertEqual(r._tobytes(), b'\x02\x00\x04xy\x00\x05xyz\x00')
+        self.assertEqual(s(items = [item()])._tobytes(), b'\x01\x00\x02')
+        arr = nstruct((uint16[2], 'v'), (point, 'p'), name = 'arr', padding = 1)
+        e = lazyarray(arr, cache = False).create(b'\x00\x01\x00\x02\x00\x03\x00\x04')[0]
+        self.assertEqual((e.v, e.p.y), ([1, 2], 4))
+        self.assertRaises(TypeError, e.v.append, 3)
+        self.assertRaises(TypeError, setattr, e.p, 'x', 1)
+        c = e._clone()
+        c.v[0] = 5
+        c.p.x = 6
+        self.assertEqual(c._tobytes(), b'\x00\x05\x00\x02\x00\x06\x00\x04')
+    def testTruncatedSize(self):
+        s = nstruct((uint16, 'length'), (uint8, 'type'), (raw, 'data'), name = 's', padding = 2,
+                    size = lambda x: x.length, prepack = packrealsize('length'))
+        self.assertIsNone(s.parse(b'\x00\x07\x01abc'))
+        self.assertIsNone(s.parse(b'\x00\x05\x01a'))
+        r, size = s.parse(b'\x00\x05\x01ab\x00\x00\x07')
+        self.assertEqual(size, 6)
+        self.assertEqual(r.data, b'ab')
+    def testRecordBatch(self):
+        hdr = nstruct((uint16, 'length'), (uint8, 'type'), name = 'hdr', padding = 1)
+        item = nstruct((uint16, 'length'), (uint8, 'type'), (raw, 'data'), name = 'item', padding = 2,
+                       size = lambda x: x.length, prepack = packrealsize('length'))
+        batch = RecordBatch(item)
+        batch.append(item(type = 1, data = b'a'))
+        self.assertEqual(batch.extend_bytes(b'\x00\x05\x02bc\x00\x00\x03\x03\x00\x00\x06\x01'), 10)
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(batch.tobytes(), b'\x00\x04\x01a\x00\x05\x02bc\x00\x00\x03\x03\x00')
+        self.assertEqual([r.data for r in batch], [b'a', b'bc', b''])
+        self.assertEqual(batch[-2].type, 2)
+        self.assertRaises(IndexError, lambda: batch[3])
+        self.assertEqual(list(v.tobytes() for v in batch.views()), [b'\x00\x04\x01a', b'\x00\x05\x02bc\x00', b'\x00\x03\x03\x00'])
+        self.assertEqual(batch[1:].tobytes(), b'\x00\x05\x02bc\x00\x00\x03\x03\x00')
+        self.assertEqual([r.type for r in batch[::2]], [1, 3])
+        self.assertEqual(batch.peek(1, hdr).length, 5)
+        odd = batch.filter(lambda h: h.type % 2, hdr)
+        self.assertEqual(odd.getbytes(1), b'\x00\x03\x03\x00')
+        self.assertEqual(len(batch.filter(lambda r: r.data)), 2)
+        both = odd + batch[1:2]
+        self.assertEqual([r.type for r in both], [1, 3, 2])
+        batch += both
+        self.assertEqual(len(batch), 6)
+        self.assertEqual(RecordBatch(item, batch.tobytes()).tobytes(), batch.tobytes())
+        tail = RecordBatch(item)
+        self.assertEqual(tail.extend_bytes(b'\x00\x03\x01\x00\x00\x05\x02bc'), 9)
+        self.assertEqual(tail.getbytes(1), b'\x00\x05\x02bc')
+        self.assertRaises(TypeError, lambda: batch + RecordBatch(hdr))
+        def iadd():
+            b = RecordBatch(item)
+            b += RecordBatch(hdr)
+        self.assertRaises(TypeError, iadd)
+    def testBitfieldInline(self):
+        vl = bitfield(uint8, (4, 'version'), (4, 'ihl'), name = 'vl', inline = True)
+        fo = bitfield(uint16, (1, 'flags', 3), (13, 'frag_off'), name = 'fo', inline = True)
+        fo_le = bitfield(uint16_le, (3, 'flags'), (13, 'frag_off'), name = 'fo_le', inline = True)
+        s = nstruct((vl,), (uint8, 'ttl'), (fo, 'frag'), name = 's', padding = 1, extend = {'version': pre_enum})
+        self.assertEqual(s.inline()[0], '>BB>H')
+        r = s.create(b'\x45\x40\x40\x05')
+        self.assertEqual((r.version, r.ihl, r.ttl, r.frag.flags, r.frag.frag_off), (4, 5, 64, [0, 1, 0], 5))
+        self.assertEqual(dump(r, typeinfo = DUMPTYPE_NONE)['version'], 'PRE_C')
+        r.ihl = 6
+        r.frag.flags[0] = 1
+        self.assertEqual(r._tobytes(), b'\x46\x40\xc0\x05')
+        self.assertEqual(s()._tobytes(), b'\x00\x00\x00\x00')
+        s2 = nstruct((vl,), (fo_le,), name = 's2', padding = 1)
+        self.assertEqual(s2.create(b'\x45\x05\x40').frag_off, 5)
+        self.assertEqual(s2(version = 4, flags = 2)._tobytes(), b'\x40\x00\x40')
+        s3 = nstruct((bitfield(uint8, (4, 'version'), (4, 'ihl')),), (uint8, 'ttl'),
+                     name = 's3', padding = 1)
+        self.assertIsNone(s3.inline())
+        self.assertEqual(s3.create(b'\x45\x40').ihl, 5)
+        fo2 = bitfield(uint16, (3, 'flags'), (13, 'frag_off'), name = 'fo2')
+        s4 = nstruct((uint8, 'ttl'), (fo2, 'frag'), name = 's4', padding = 1)
+        r = s4.create(b'\x40\x40\x05')
+        self.assertIs(r.frag._gettype(), fo2)
+        self.assertEqual(r.frag._tobytes(), b'\x40\x05')
+        self.assertEqual(len(r.frag), 2)
+        self.assertEqual(dump(r)['frag']['_type'], '<fo2>')
+    def testMixedEndian(self):
+        le16 = prim('H', 'le16', '<', True)
+        le32 = prim('I', 'le32', '<', True)
+        s = nstruct((uint16, 'type'), (le32, 'cookie'), (uint8, 'flags'), (le16[2], 'ports'), (uint16, 'xid'),
+                    name = 's', padding = 1)
+        self.assertIsNotNone(s.inline())
+        data = b'\x00\x01\x04\x03\x02\x01\x05\x01\x00\x02\x00\x00\x09'
+        r = s.create(data)
+        self.assertEqual((r.type, r.cookie, r.flags, r.ports, r.xid), (1, 0x01020304, 5, [1, 2], 9))
+        self.assertEqual(r._tobytes(), data)
+        self.assertEqual(s.parse(data[:-1]), None)
+        self.assertEqual(s(ports = [3])._tobytes(), b'\x00\x00\x00\x00\x00\x00\x00\x03\x00\x00\x00\x00\x00')
+        s2 = nstruct((uint16, 'a'), (s, 'inner'), name = 's2', padding = 1, endian = '<')
+        r2 = s2.create(b'\x01\x00' + data)
+        self.assertEqual((r2.a, r2.inner.type, r2.inner.cookie, r2.inner.xid), (1, 0x100, 0x01020304, 0x900))
+        self.assertEqual(r2._tobytes(), b'\x01\x00' + data)
+    def testExpr(self):
+        s = nstruct((uint16, 'length'), (uint8, 'type'), name = 's', padding = 2, size = F.length)
+        s1 = nstruct((uint8[0], 'values'), base = s, name = 's1', criteria = F.type == 1, init = packvalue(1, 'type'))
+        s2 = nstruct((raw, 'text'), base = s, name = 's2', criteria = F.type.in_((2, 3)), init = packvalue(2, 'type'))
+        self.assertEqual(s2(text = b'abc')._tobytes(), b'\x00\x06\x02abc')
+        self.assertEqual(s.parse(b'\x00\x05\x01\x07\x08\x00')[0].values, [7, 8])
+        self.assertEqual(s.parse(b'\x00\x04\x03a\xff')[0].text, b'a')
+        self.assertEqual(s.create(b'\x00\x03\x04')._gettype(), s)
+        self.assertIsNotNone(s.criteriaindex)
+        r = s1.new(values = [1])
+        e = (F.length + 1) * 2 - F.type
+        self.assertEqual(repr(e), '(((F.length + 1) * 2) - F.type)')
+        self.assertEqual(e._fields(), set([('length',), ('type',)]))
+        r._prepack()
+        self.assertEqual(e(r), 9)
+        self.assertEqual((10 - F.length)(r), 6)
+        self.assertEqual(and_(F.type == 1, F.length > 3)(r), True)
+        self.assertEqual(or_(F.type == 2, not_(F.length))(r), False)
+        self.assertEqual(((F.type == 1) & (F.length == 4))(r), True)
+        self.assertRaises(TypeError, bool, F.type == 1)
+        self.assertEqual((F.length - 8)._inverse()[1](4), 12)
+        self.assertEqual((F.length * 2)._inverse(), None)
+        h = nstruct((uint8, 'type'), (uint8, 'length'), name = 'h', padding = 1)
+        t = nstruct((h, 'header'), name = 't', padding = 1, size = F.header.length + 2,
+                    classifier = F.header.type)
+        t1 = nstruct((uint8, 'a'), base = t, name = 't1', classifyby = (1,), init = packvalue(1, 'header', 'type'))
+        self.assertEqual(t1(a = 5)._tobytes(), b'\x01\x01\x05')
+        self.assertEqual(t.create(b'\x01\x01\x06').a, 6)
+    def testRegisterAfterCompile(self):
+        base = nstruct((uint8, 'type'), (uint8, 'length'), name = 'base', padding = 1, classifier = lambda x: x.type,
+                       size = lambda x: x.length, prepack = packrealsize('length'))
+        sub = nstruct((uint8, 'a'), base = base, name = 'sub', classifyby = (1,), init = packvalue(1, 'type'))
+        bp = base.parser()
+        compile = sub._compile
+        registered = []
+        def _compile():
+            p = compile()
+            # Neither registered nor published yet
+            registered.append((p in bp.subclasses or p in bp.subindices.values(), '_parser' in sub.__dict__))
+            return p
+        sub._compile = _compile
+        p = sub.parser()
+        self.assertEqual(registered, [(False, False)])
+        self.assertIs(sub._parser, p)
+        self.assertIn(p, bp.subclasses)
+        self.assertIs(bp.subindices[1], p)
+        self.assertEqual(base.create(b'\x01\x03\x05').a, 5)
+    def testFlattenAfterNamedMember(self):
+        s = nstruct((cstr, 'name'), (uint16,), (uint8[0], 'data'), name = 's', padding = 1)
+        r = s.create(b'ab\x00\x00\x01\x02\x03')
+        self.assertEqual(dump(r, typeinfo = DUMPTYPE_NONE), {'name': b'ab', 'data': [2, 3]})
+        self.assertEqual(r._tobytes(), b'ab\x00\x00\x00\x02\x03')
+    def testArrayElementExtra(self):
+        elem = nstruct((uint16, 'a'), name = 'elem', padding = 1)
+        vparent = nstruct((uint16, 'length'),
+                          (elem[0], 'items'),
+                          name = 'vparent',
+                          size = lambda x: x.length,
+                          prepack = packrealsize('length'),
+                          padding = 1)
+        fparent = nstruct((uint16, 'length'),
+                          (elem[2], 'items'),
+                          name = 'fparent',
+                          size = lambda x: x.length,
+                          prepack = packrealsize('length'),
+                          padding = 1)
+        for t in (vparent, fparent):
+            e = elem.new(a = 1)
+            e._setextra(b'xy')
+            s = t.new(items = [e, elem.new(a = 2)])
+            self.assertEqual(s._tobytes(), b'\x00\x08\x00\x01xy\x00\x02')
+            self.assertEqual(s.length, 8)
+            self.assertEqual(len(s), 8)
+    def testThreadedCompile(self):
+        import threading
+        s1 = nstruct((uint8, 'type'),
+                     name = 's1',
+                     padding = 1,
+                     classifier = lambda x: x.type)
+        subtypes = [nstruct((uint8, 'a'), base = s1, classifyby = (i,), name = 's1_%d' % (i,), init = packvalue(i, 'type'))
+                    for i in range(0, 32)]
+        data = [bytes(bytearray((i, i))) for i in range(0, 32)]
+        errors = []
+        start = threading.Event()
+        def worker():
+            start.wait()
+            for _ in range(0, 10):
+                for i, d in enumerate(data):
+                    r = s1.create(d)
+                    if r._gettype() is not subtypes[i] or r.a != i:
+                        errors.append(i)
+        threads = [threading.Thread(target = worker) for _ in range(0, 8)]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        p = s1.parser()
+        self.assertEqual(len(p.subclasses), 32)
+        self.assertEqual([p.subindices[i] for i in range(0, 32)], [t.parser() for t in subtypes])
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file